@@ -0,0 +1,6 @@
+"""Benchmarks of loading, saving, querying and rendering task lists.
+
+    python -m benchmarks.generate tasks.xml --areas 20 --projects 50
+    python -m benchmarks.run --out before.json
+    python -m benchmarks.run --out after.json --compare before.json
+"""
@@ -0,0 +1,99 @@
+"""Generate synthetic task lists of a given size.
+"""
+import argparse
+import datetime
+import random
+import sys
+
+import gtd
+from gtd import db
+from gtd import items as it
+
+WORDS = ['call', 'email', 'write', 'review', 'invoice', 'plan', 'buy', 'fix',
+         'read', 'book', 'report', 'meeting', 'draft', 'pay', 'order', 'check',
+         'update', 'clean', 'prepare', 'send']
+AREA_NAMES = ['Inbox', 'Next', 'Waiting', 'Someday', 'Work', 'Home']
+
+
+def generate(areas=6, projects=10, actions=20, tags=20, max_tags=3,
+             due_ratio=0.3, desc_ratio=0.2, done_ratio=0.3, arch_ratio=0.2,
+             seed=0):
+    """Return a DataBase with 'projects' projects per area and 'actions'
+    actions per project and directly in every area.
+    """
+    rnd = random.Random(seed)
+    tag_pool = ['t%d' % i for i in range(tags - 1)] + ['!']
+    today = datetime.date.today().toordinal()
+
+    def _name():
+        return ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 5)))
+
+    def _action():
+        action = it.Action(_name())
+        action.add_tags(rnd.sample(tag_pool, rnd.randint(0, max_tags)))
+        if rnd.random() < due_ratio:
+            action.due = today + rnd.randint(-60, 120)
+        if rnd.random() < desc_ratio:
+            action.description = _name() + ' ' + _name()
+        if rnd.random() < done_ratio:
+            action.mark_done()
+        if rnd.random() < arch_ratio:
+            action.mark_archieved()
+        return action
+
+    database = db.DataBase()
+
+    for i in range(areas):
+        area = it.Area('%s %d' % (AREA_NAMES[i % len(AREA_NAMES)], i))
+
+        for _ in range(projects):
+            project = it.Project(_name())
+            project.actions = [_action() for _ in range(actions)]
+            area.projects.append(project)
+
+        area.actions = [_action() for _ in range(actions)]
+        database.append(area)
+
+    return database
+
+
+def add_arguments(parser):
+    parser.add_argument('--areas', type=int, default=6)
+    parser.add_argument('--projects', type=int, default=10,
+                        help='projects per area')
+    parser.add_argument('--actions', type=int, default=20,
+                        help='actions per project and per area')
+    parser.add_argument('--tags', type=int, default=20,
+                        help='number of distinct tags')
+    parser.add_argument('--max-tags', type=int, default=3,
+                        help='maximum number of tags of an action')
+    parser.add_argument('--due', type=float, default=0.3,
+                        help='ratio of actions with a due date')
+    parser.add_argument('--desc', type=float, default=0.2,
+                        help='ratio of actions with a description')
+    parser.add_argument('--done', type=float, default=0.3,
+                        help='ratio of done actions')
+    parser.add_argument('--arch', type=float, default=0.2,
+                        help='ratio of archieved actions')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def from_arguments(args):
+    return generate(areas=args.areas, projects=args.projects,
+                    actions=args.actions, tags=args.tags,
+                    max_tags=args.max_tags, due_ratio=args.due,
+                    desc_ratio=args.desc, done_ratio=args.done,
+                    arch_ratio=args.arch, seed=args.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('file_name')
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    gtd.save(from_arguments(args), args.file_name)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
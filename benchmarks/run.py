@@ -0,0 +1,250 @@
+"""Time loading, saving, querying, item lookups, sorting and rendering of a
+synthetic task list and report throughput and peak memory.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import gtd
+from gtd import formatter as fmt
+
+from . import generate
+
+QUERIES = [
+    ('list', 'list'),
+    ('tag', 's tag t1'),
+    ('tags', 's tag t1 tag t2 tag !'),
+    ('due', 's due <= eow'),
+    ('today', 's due today'),
+    ('done', 's done True'),
+    ('act', 's act invoice'),
+    ('proj', 's proj review'),
+    ('area', 's area next'),
+    ('archive', 's arch True'),
+]
+SORTS = ['sort name', 'sort due', 'sort name desc']
+ALIAS = '"past":"s done True arch True"\n"td":"s due today"\n'
+OPTIONS = "'show_tags': True\n'show_due_date': True\n" \
+    "'show_description': True\n"
+
+
+class Bench:
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = {}
+
+    def measure(self, name, func, items, setup=None):
+        """Run func a few times and keep the best time; then once more with
+        tracemalloc to get its peak memory.
+        """
+        best = None
+        for _ in range(self.repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        if setup:
+            setup()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        self.results[name] = {
+            'seconds': best,
+            'items': items,
+            'per_sec': items / best if best else None,
+            'peak_kb': peak // 1024
+        }
+        print('{:<22}{:>12.4f} s{:>14.0f} items/s{:>12d} kB'.format(
+            name, best, items / best if best else 0, peak // 1024))
+
+    def measure_memory(self, name, func, actions):
+        """Memory held by whatever func returns, per action.
+        """
+        gc.collect()
+        tracemalloc.start()
+        result = func()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del result
+
+        self.results[name] = {
+            'bytes': size,
+            'items': actions,
+            'bytes_per_action': size / actions
+        }
+        print('{:<22}{:>12.0f} B/action{:>12d} kB'.format(
+            name, size / actions, size // 1024))
+
+
+def count_items(database):
+    n = 0
+    for area in database:
+        n += 1 + len(area.actions) + len(area.projects)
+        for project in area.projects:
+            n += len(project.actions)
+    return n
+
+
+def count_actions(database):
+    n = 0
+    for area in database:
+        n += len(area.actions)
+        for project in area.projects:
+            n += len(project.actions)
+    return n
+
+
+def run(args):
+    bench = Bench(args.repeat)
+    source = generate.from_arguments(args)
+    n_items = count_items(source)
+    n_actions = count_actions(source)
+    print('{} items, {} actions'.format(n_items, n_actions))
+
+    os.chdir(args.workdir)
+    with open('alias.txt', 'w') as f:
+        f.write(ALIAS)
+    with open('options.txt', 'w') as f:
+        f.write(OPTIONS)
+
+    file_name = os.path.join(args.workdir, 'tasks.xml')
+    gtd.save(source, file_name)
+    del source
+
+    def _drop_cache():
+        if os.path.isfile(file_name + '.cache'):
+            os.remove(file_name + '.cache')
+
+    bench.measure('load', lambda: gtd.load(file_name), n_items,
+                  setup=_drop_cache)
+    bench.measure('load_cached', lambda: gtd.load(file_name), n_items)
+
+    bench.measure_memory('memory:items',
+                         lambda: list(gtd.iterload(file_name)), n_actions)
+    bench.measure_memory('memory:database', lambda: gtd.load(file_name),
+                         n_actions)
+
+    database = gtd.load(file_name)
+    bench.measure('save', lambda: gtd.save(database, file_name + '.out'),
+                  n_items, setup=database.touch)
+
+    action = database.areas[-1].actions[0]
+    bench.measure('save:one_area',
+                  lambda: gtd.save(database, file_name + '.out'), n_items,
+                  setup=lambda: database.apply('edit', action, action.name))
+
+    ui = gtd.Interface(database)
+    columns = gtd.load(file_name, backend='columns')
+
+    for name, cmd in QUERIES:
+        if cmd == 'list':
+            ui._list(cmd)
+        else:
+            ui._select(cmd)
+        bench.measure('query:' + name,
+                      lambda: list(database.query(ui.user_filter)), n_items)
+        bench.measure('columns:' + name,
+                      lambda: list(columns.query(ui.user_filter)), n_items)
+
+        if args.workers > 1:
+            database.workers = args.workers
+            database.parallel_threshold = 0
+            list(database.query(ui.user_filter))  # fork the workers
+            bench.measure('parallel:' + name,
+                          lambda: list(database.query(ui.user_filter)),
+                          n_items)
+            database.workers = 0
+
+    ui._list('list')
+    n_shown = len(ui._view())
+    lookups = [random.randint(1, n_shown) for _ in range(1000)]
+
+    def _lookup():
+        for i in lookups:
+            ui._get_item(i)
+
+    bench.measure('get_item', _lookup, len(lookups))
+
+    for cmd in SORTS:
+        with contextlib.redirect_stdout(io.StringIO()):
+            ui._sort(cmd)
+        bench.measure(cmd.replace(' ', ':'),
+                      lambda: list(database.query(ui.user_filter)), n_items)
+    ui.default_sort()
+
+    nodes = ui._view()
+
+    def _render():
+        fmt.format_items(nodes, ui.options)
+
+    bench.measure('render', _render, len(nodes))
+
+    return {
+        'gtd': gtd.__version__,
+        'python': platform.python_version(),
+        'params': {k: v for k, v in vars(args).items()
+                   if k not in ['out', 'compare', 'workdir']},
+        'results': bench.results
+    }
+
+
+def compare(old, new):
+    print('\n{:<22}{:>12}{:>12}{:>9}'.format('', 'before', 'after', 'ratio'))
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+
+        key = 'seconds' if 'seconds' in result else 'bytes_per_action'
+        if key not in old['results'][name]:
+            continue
+
+        before = old['results'][name][key]
+        after = result[key]
+        print('{:<22}{:>12.4f}{:>12.4f}{:>9.2f}'.format(
+            name, before, after, before / after if after else 0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    generate.add_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=0,
+                        help='also run queries on that many processes')
+    parser.add_argument('--out', help='store results in a json file')
+    parser.add_argument('--compare', help='results of an earlier run')
+    args = parser.parse_args(argv)
+
+    cwd = os.getcwd()
+    args.workdir = tempfile.mkdtemp(prefix='pyorganize-bench-')
+    try:
+        results = run(args)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(args.workdir)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
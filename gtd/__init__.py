@@ -1,4 +1,5 @@
+from .autosave import AutoSave
 from .interface import Interface
-from .io import load, save
+from .io import iterload, load, save
 
 __version__ = 0.1
@@ -0,0 +1,105 @@
+import sys
+import threading
+
+from . import io
+from . import sqldb
+
+
+class AutoSave:
+    """Save the database on a worker thread once it has not changed for
+    'delay' seconds, or at the latest 'max_delay' seconds after it first
+    changed. Items are copied between two commands and the copy is written
+    on the worker, so commands never wait for the file.
+
+    An SQLite database is written through by every command, so saving it
+    only commits the tables.
+    """
+
+    def __init__(self, database, file_name, delay=2.0, max_delay=60.0):
+        self.db = database
+        self.file_name = file_name
+        self.delay = delay
+        self.max_delay = max_delay
+        self._stopped = threading.Event()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def is_running(self):
+        return self._thread.is_alive() and not self._stopped.is_set()
+
+    def request(self):
+        """Ask the worker to save as soon as it can, e.g. as the journal is
+        full.
+        """
+        self._wake.set()
+
+    def stop(self):
+        """Stop the worker and save whatever it has not saved yet.
+        """
+        self._stopped.set()
+        self._wake.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.save()
+
+    def save(self):
+        """Save the database if it changed since it was saved last time.
+        """
+        database = self.db
+
+        if isinstance(database, sqldb.SQLDataBase):
+            with database.lock:
+                database.commit()
+                database.mark_saved()
+            return
+
+        with database.save_lock:
+            with database.lock:
+                if not database.is_dirty:
+                    return
+
+                log = database.journal
+                if log is not None and log.snapshot != self.file_name:
+                    log = None
+
+                seq = log.seq if log is not None else 0
+                parts = io.snapshot(database, self.file_name)
+                version = database.version
+
+            io.write(parts, self.file_name, seq)
+
+            with database.lock:
+                if log is not None:
+                    log.truncate(seq)
+                database.mark_saved(version)
+
+    def _run(self):
+        seen = self.db.version
+        waited = 0.0
+
+        while True:
+            requested = self._wake.wait(self.delay)
+            self._wake.clear()
+            if self._stopped.is_set():
+                return
+
+            version = self.db.version
+
+            if not self.db.is_dirty:
+                waited = 0.0
+            elif requested or version == seen or \
+                    waited + self.delay >= self.max_delay:
+                try:
+                    self.save()
+                except OSError as e:
+                    # changes are safe in the journal, try again later
+                    sys.stderr.write('Autosave failed: ' + str(e) + '\n')
+                waited = 0.0
+            else:
+                waited += self.delay
+
+            seen = version
@@ -0,0 +1,63 @@
+"""Send commands to a running gtd.server and print its replies.
+
+    python -m gtd.client 'tag 3 home'
+    python -m gtd.client --show 'tag 3 home'
+    echo 'done 3' | python -m gtd.client
+"""
+import argparse
+import socket
+import sys
+
+from . import server
+
+
+class Client:
+    def __init__(self, address):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self._buffer = b''
+
+    def send(self, cmd, show=False):
+        """Run a command on the server and return its reply, along with the
+        list if 'show' is set.
+        """
+        if show:
+            cmd = server.SHOW + cmd
+        self.sock.sendall(cmd.encode('utf-8') + b'\n')
+
+        while server.END not in self._buffer:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError('Server closed the connection')
+            self._buffer += chunk
+
+        reply, _, self._buffer = self._buffer.partition(server.END)
+        return reply.decode('utf-8')
+
+    def close(self):
+        self.sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('command', nargs='*',
+                        help='command to run; read from stdin if not given')
+    parser.add_argument('--file', default='tasks.xml',
+                        help='task file the server was started with')
+    parser.add_argument('--socket', help='path of the socket')
+    parser.add_argument('--show', action='store_true',
+                        help='print the list after every command')
+    args = parser.parse_args(argv)
+
+    client = Client(args.socket or server.default_address(args.file))
+    try:
+        cmds = [' '.join(args.command)] if args.command else sys.stdin
+        for cmd in cmds:
+            if cmd.strip():
+                sys.stdout.write(client.send(cmd.strip(), args.show))
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,371 @@
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import db
+from . import items as it
+
+_TAG_BITS = 64  # tags with a bit in the tag masks, in the order they appear
+
+
+class ColumnDataBase(db.DataBase):
+    """DataBase keeping the attributes filters look at in packed columns,
+    one row per action: done and archived flags, due date ordinals, ids of
+    the containers and a tag mask. Filters of a query are evaluated over
+    whole columns at once, with NumPy if it is installed, and the actions
+    to show are taken from the rows which passed, grouped by the column of
+    containers. Names are looked up in the trigram index and marked in a
+    mask as well.
+
+    Rows of a container are in the order of its list, as actions are only
+    appended to lists; a moved action gets a new row, leaving its old one
+    without a container until the database is compacted.
+
+    Without NumPy a column of flags is taken as an integer, a byte per row,
+    so that flags are still combined by a single operation.
+    """
+
+    def __init__(self):
+        super(ColumnDataBase, self).__init__()
+        self._clear()
+
+    def reindex(self):
+        self._clear()
+        super(ColumnDataBase, self).reindex()
+
+    def apply(self, op, *args):
+        """Apply a command and update the rows of the actions it changed.
+        """
+        with self.lock:
+            if op == 'add':
+                item = super(ColumnDataBase, self).apply(op, *args)
+                if not isinstance(item, it.Project):
+                    self._append(item)
+                return item
+
+            nodes = _actions(args[0]) if op in ['arch', 'done'] \
+                else [args[0]]
+            ret = super(ColumnDataBase, self).apply(op, *args)
+
+            if op == 'move':
+                self._unlink(args[0])
+                self._append(args[0])
+            else:
+                for node in nodes:
+                    self._store(node)
+            return ret
+
+    def compact(self, keep=()):
+        with self.lock:
+            removed = super(ColumnDataBase, self).compact(keep)
+            if removed:
+                self._clear()
+                for area in self.areas:
+                    for action in _actions(area):
+                        self._append(action)
+            return removed
+
+    def _clear(self):
+        self._rows = []  # row -> action, or None if it has moved
+        self._row_of = {}  # action id -> row
+        self._done = bytearray()
+        self._arch = bytearray()
+        self._due = array.array('q')  # ordinals, 0 if there is no due date
+        self._parent = array.array('q')  # ids of the containers
+        self._tagmask = array.array('Q')
+        self._tag_bits = {}  # tag -> bit
+
+    def _index_action(self, action, parent):
+        super(ColumnDataBase, self)._index_action(action, parent)
+        self._append(action)
+
+    def _append(self, action):
+        self._row_of[action.id] = len(self._rows)
+        self._rows.append(action)
+        self._done.append(0)
+        self._arch.append(0)
+        self._due.append(0)
+        self._parent.append(0)
+        self._tagmask.append(0)
+        self._store(action)
+
+    def _row(self, action):
+        """Row of an action, or None if it has none, e.g. as it is a project.
+        """
+        row = self._row_of.get(action.id)
+        if row is None or self._rows[row] is not action:
+            return None
+        return row
+
+    def _unlink(self, action):
+        """Leave the row of an action behind, matching no container.
+        """
+        row = self._row(action)
+        if row is not None:
+            self._rows[row] = None
+            self._parent[row] = 0
+
+    def _store(self, action):
+        """Copy attributes of an action into its row, if it has one.
+        """
+        row = self._row(action)
+        if row is None:
+            return
+
+        self._done[row] = action.is_done
+        self._arch[row] = action.is_archieved
+        self._due[row] = action.due or 0
+        self._parent[row] = action.parent.id
+        self._tagmask[row] = self._mask(action.tags)
+
+    def _mask(self, tags):
+        mask = 0
+        for tag in tags:
+            bit = self._tag_bits.get(tag)
+            if bit is None and len(self._tag_bits) < _TAG_BITS:
+                bit = self._tag_bits[tag] = len(self._tag_bits)
+            if bit is not None:
+                mask |= 1 << bit
+        return mask
+
+    def _filter(self, args, areas):
+        """Yield areas and projects to be shown along with their actions,
+        the same as DataBase._filter(), taking the actions from the rows
+        which passed the filter and telling which containers to show from
+        the rows which passed it regardless of 'arch'. Lists of actions are
+        not looked at.
+        """
+        loose_args = dict(args)
+        loose_args.pop('arch', None)
+
+        named_areas = self._named(args['area']) if 'area' in args else None
+        named_projects = self._named(args['proj']) if 'proj' in args \
+            else None
+
+        mask = self._filter_mask(args)
+        if mask is not None and (named_areas is not None or
+                                 named_projects is not None):
+            mask = mask & self._containers_mask(named_areas, named_projects)
+        groups = self._groups(mask) if mask is not None else None
+        loose = self._filter_mask(loose_args) if loose_args else None
+        parents = self._parents(loose) if loose is not None else None
+        area_actions = named_projects is None
+
+        def check_area(node):
+            return named_areas is None or node in named_areas
+
+        def check_proj(node):
+            return named_projects is None or node in named_projects
+
+        def _shown(node):
+            if groups is None:
+                return list(node.actions)
+            return groups.get(node.id, [])
+
+        def _has_elem(node):
+            if parents is not None:
+                return node.id in parents
+            # no filter of actions but names, any action passes
+            return not loose_args or bool(node.actions)
+
+        for area in areas:
+            if not check_area(area):
+                continue
+
+            if area_actions:
+                actions, has_elem = _shown(area), _has_elem(area)
+            else:
+                actions, has_elem = [], not loose_args
+
+            projects = []
+            project_actions = {}
+            for project in area.projects:
+                if check_proj(project) and _has_elem(project):
+                    projects.append(project)
+                    project_actions[project] = _shown(project)
+
+            if has_elem or projects:
+                yield area, actions, projects, project_actions
+
+    def _is_parallel(self):
+        # masks are computed over whole columns, workers would each do it
+        return False
+
+    def _filter_mask(self, fltr):
+        """Rows passing the filter, as a NumPy array of flags or an integer
+        with a byte per row, or None if no rows are filtered out.
+        """
+        mask = None
+
+        for k, v in fltr.items():
+            if k == 'act':
+                m = self._rows_mask(self._named(v))
+            elif k == 'tag':
+                m = self._tags_mask(v)
+            elif k == 'due':
+                m = self._due_mask(v)
+            elif k == 'done':
+                m = self._flag_mask(self._done, v)
+            elif k == 'arch':
+                m = self._flag_mask(self._arch, v)
+            else:
+                continue
+
+            mask = m if mask is None else mask & m
+            if k == 'due':
+                break  # filters after due are never checked
+
+        return mask
+
+    def _containers_mask(self, named_areas, named_projects):
+        """Rows of the actions in the areas and projects passing the 'area'
+        and 'proj' filters, which are the only ones that can be shown.
+        """
+        areas = self.areas
+        if named_areas is not None:
+            areas = [x for x in named_areas if isinstance(x, it.Area)]
+
+        if named_projects is not None:
+            areas = set(areas)
+            containers = [x for x in named_projects
+                          if not isinstance(x, it.Area) and
+                          isinstance(x, it.Project) and x.parent in areas]
+        else:
+            containers = list(areas)
+            for area in areas:
+                containers.extend(area.projects)
+
+        if numpy is None:
+            return self._rows_mask(x for container in containers
+                                   for x in container.actions)
+
+        return numpy.isin(numpy.frombuffer(self._parent, numpy.int64),
+                          [x.id for x in containers])
+
+    def _groups(self, mask):
+        """Actions of the rows in a mask by the ids of their containers, in
+        the order of the rows.
+        """
+        groups = {}
+        actions = self._rows.__getitem__
+
+        if numpy is None:
+            for row in _ones(mask.to_bytes(len(self._rows), 'little')):
+                parent = self._parent[row]
+                if parent:
+                    groups.setdefault(parent, []).append(actions(row))
+            return groups
+
+        rows = numpy.flatnonzero(mask)
+        parents = numpy.frombuffer(self._parent, numpy.int64)[rows]
+        order = numpy.argsort(parents, kind='stable')
+        rows, parents = rows[order], parents[order]
+        bounds = numpy.flatnonzero(numpy.diff(parents)) + 1
+
+        for parent, run in zip(parents[numpy.r_[0, bounds]].tolist()
+                               if len(rows) else [],
+                               numpy.split(rows, bounds)):
+            if parent:
+                groups[parent] = list(map(actions, run.tolist()))
+        return groups
+
+    def _parents(self, mask):
+        """Ids of the containers holding the rows in a mask.
+        """
+        if numpy is not None:
+            parents = set(numpy.unique(numpy.frombuffer(
+                self._parent, numpy.int64)[mask]).tolist())
+        else:
+            flags = mask.to_bytes(len(self._rows), 'little')
+            parents = set(self._parent[i] for i in _ones(flags))
+
+        parents.discard(0)
+        return parents
+
+    def _flag_mask(self, column, values):
+        if numpy is not None:
+            column = numpy.frombuffer(column, numpy.uint8)
+            mask = numpy.zeros(len(column), bool)
+            for value in set(values):
+                mask |= column == int(value)
+            return mask
+
+        flags = int.from_bytes(column, 'little')
+        mask = 0
+        for value in set(values):
+            mask |= flags if value else flags ^ _all_ones(len(column))
+        return mask
+
+    def _due_mask(self, dues):
+        if numpy is None:
+            return self._rows_mask(x for due in dues
+                                   for x in self._due_range(due))
+
+        column = numpy.frombuffer(self._due, numpy.int64)
+        mask = numpy.zeros(len(column), bool)
+        for due in dues:
+            if due.ordinal is not None:
+                mask |= (column != 0) & due.operators[due.op](column,
+                                                              due.ordinal)
+        return mask
+
+    def _tags_mask(self, tags):
+        if numpy is None:
+            return self._rows_mask(x for tag in tags
+                                   for x in self._tags.get(tag, ()))
+
+        bits = 0
+        others = []
+        for tag in tags:
+            if tag in self._tag_bits:
+                bits |= 1 << self._tag_bits[tag]
+            else:
+                others.extend(self._tags.get(tag, ()))
+
+        column = numpy.frombuffer(self._tagmask, numpy.uint64)
+        mask = (column & numpy.uint64(bits)) != 0
+        rows = [x for x in map(self._row, others) if x is not None]
+        if rows:
+            mask[rows] = True
+        return mask
+
+    def _rows_mask(self, actions):
+        rows = [x for x in map(self._row, actions) if x is not None]
+
+        if numpy is not None:
+            mask = numpy.zeros(len(self._rows), bool)
+            mask[rows] = True
+            return mask
+
+        flags = bytearray(len(self._rows))
+        for row in rows:
+            flags[row] = 1
+        return int.from_bytes(flags, 'little')
+
+
+def _actions(node):
+    """Actions of an item, including the item itself if it is one.
+    """
+    if not isinstance(node, it.Project):
+        return [node]
+
+    actions = list(node.actions)
+    for project in getattr(node, 'projects', []):
+        actions.extend(project.actions)
+    return actions
+
+
+def _all_ones(n):
+    return int.from_bytes(b'\x01' * n, 'little')
+
+
+def _ones(flags):
+    """Positions of the ones in a byte string of flags.
+    """
+    i = flags.find(1)
+    while i != -1:
+        yield i
+        i = flags.find(1, i + 1)
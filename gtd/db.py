@@ -1,134 +1,757 @@
-from .formatter import format_date
-from .items import Area
+import bisect
+import contextlib
+import copy
+import threading
+
+from . import events
+from . import parallel
+from .items import Action, Area, Project
+
+# attributes set by commands changing items in place
+_FIELDS = {
+    'arch': ('is_archieved',),
+    'clean': ('tags', 'due'),
+    'del': ('is_deleted', 'is_archieved'),
+    'desc': ('description',),
+    'done': ('is_done',),
+    'due': ('due',),
+    'edit': ('name',),
+    'tag': ('tags',)
+}
 
 
 class DataBase:
     """DataBase object stores all the information from the xml file into memory.
+
+    Every item has an id, unique within the database, and a link to its
+    parent. Items loaded without an id get one when they are indexed.
+
+    Changes are announced to subscribers of 'events'.
     """
 
     def __init__(self):
         self.areas = []
         self._sort_by = lambda x: x.is_done
         self._sort_rev = False
+        self.journal = None
+        self.version = 0  # bumped by every change of the items
+        self._saved = 0  # version written to the file last time
+        self.lock = threading.RLock()  # held while the items change
+        self.save_lock = threading.Lock()  # held while the file is written
+        self._ids = {}  # id -> item
+        self._next_id = 1  # never reused within a session
+        self._tags = {}  # tag -> set of actions
+        self._due_keys = []  # sorted due date ordinals
+        self._due_items = []  # actions, in the order of _due_keys
+        self._grams = None  # trigram -> set of items, built when first used
+        self._lower = {}  # item -> its name in lower case, along with _grams
+        self.deleted = 0  # items deleted since the last compaction
+        self.compact_threshold = 500
+        self.events = events.EventBus()
+        self.workers = 0  # processes filtering large databases, if above 1
+        self.parallel_threshold = 200000  # items
+        self._pool = None  # pool of workers and the state they were made of
+        self._pool_state = None
+        self._pool_deltas = []  # commands applied since they were forked
 
     def __iter__(self):
         for area in self.areas:
             yield area
 
     def append(self, area):
-        self.areas.append(area)
+        self.extend([area])
 
-    def query(self, args=None):
-        """List all items in a database. Result may be filtered by applying
-        extra conditions in form of an 'args' dictionary.
+    def extend(self, areas):
+        """Append areas, e.g. read from a file. Ids they hold are kept
+        wherever they are, and items without one get ids above all of them.
         """
-        if args is None:
-            args = {}
+        areas = list(areas)
+        self._reserve_ids(areas)
+
+        for area in areas:
+            self.areas.append(area)
+            self.version += 1
+            self._index_area(area)
+            self.events.emit(events.added(area))
 
-        def _default_adjusted_args(fltr):
-            """Remove default arguments from fltr."""
-            f = dict(fltr)
-            arch = f.get('arch', None)
+    def reindex(self):
+        """Rebuild indexes from scratch, e.g. after items were changed
+        directly and not by apply().
+        """
+        self._ids = {}
+        self._tags = {}
+        self._due_keys = []
+        self._due_items = []
+        self._grams = None
+        self._reserve_ids(self.areas)
 
-            if arch == [True]:
-                f.pop('arch')
+        for area in self.areas:
+            self._index_area(area)
 
-            return f
+        self.events.emit(events.reset())
 
-        def _check_name(name, name_list):
-            name_lower = name.lower()
-            name_lower_list = [z.lower() for z in name_list]
+    def node(self, item_id):
+        """Find an item by its id.
+        """
+        return self._ids[item_id]
 
-            for i_name in name_lower_list:
-                if i_name in name_lower:
-                    return True
-            return False
+    def apply(self, op, *args):
+        """Apply a command to the items, keeping indexes up to date. The
+        command is logged before anything is changed. The id of a new item is
+        a part of the command, so that replaying it gives the same id.
+        """
+        with self.lock:
+            if op == 'add' and len(args) == 3:
+                args += (self._new_id(),)
 
-        def _check_area(node, fltr):
-            for k, v in fltr.items():
-                if k == 'area':
-                    if not _check_name(node.name, v):
-                        return False
-            return True
-
-        def _check_proj(node, fltr):
-            for k, v in fltr.items():
-                if k == 'proj':
-                    if not _check_name(node.name, v):
-                        return False
-            return True
-
-        def _check_act(node, fltr):
-            for k, v in fltr.items():
-                if k == 'act':
-                    if not _check_name(node.name, v):
-                        return False
-                elif k == 'tag':
-                    if not (set(node.tags) & set(v)):
-                        return False
-                elif k == 'due':
-                    if not node.due_date:
-                        return False
-                    for due in v:
-                        if due(format_date(node.due_date)):
-                            return True
-                    return False
-                elif k == 'done':
-                    if not (set([node.is_done]) & set(v)):
-                        return False
-                elif k == 'arch':
-                    if not (set([node.is_archieved]) & set(v)):
-                        return False
-            return True
-
-        def _get_actions(node, fltr):
-            if isinstance(node, Area) and 'proj' in fltr:
-                return []
-
-            return [action
-                    for action
-                    in sorted(node.actions, key=self._sort_by,
-                              reverse=self._sort_rev)
-                    if _check_act(action, fltr)]
-
-        def _get_projects(node, fltr):
-            def has_elem(project):
-                fargs = dict(fltr)
-                fargs.pop('arch', None)
-
-                if fargs:
-                    return any(_get_actions(project, fargs))
-                return True
+            self.log(op, *args)
+            areas = set(self._area(x) for x in args if isinstance(x, Action))
+            watch = self._watch(op, args) if self.events else None
+            ret = getattr(self, '_apply_' + op)(*args)
+            self._revise(areas)
+
+            if watch is not None:
+                self.events.emit(*watch(ret))
+            return ret
+
+    def touch(self, *nodes):
+        """Mark items changed directly, and not by apply(), along with the
+        areas holding them, or all the areas if no item is given.
+        """
+        if nodes:
+            for node in nodes:
+                self._index_name(node)
+            self._revise([self._area(x) for x in nodes])
+            self.events.emit(*[events.changed(x) for x in nodes])
+        else:
+            self._grams = None
+            self._revise(self.areas)
+            self.events.emit(events.reset())
+
+    @property
+    def is_dirty(self):
+        """Whether the items changed since they were saved.
+        """
+        return self.version != self._saved
+
+    def mark_saved(self, version=None):
+        """Remember the version of the items the file was written from.
+        """
+        self._saved = self.version if version is None else version
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Apply a batch of commands without writing each of them to the
+        journal. The database is to be saved afterwards. Subscribers are
+        told after every command, as later ones may depend on the list.
+        """
+        if self.journal is None:
+            yield
+        else:
+            with self.journal.suspended():
+                yield
 
-            return [project
-                    for project
-                    in sorted(node.projects, key=self._sort_by,
-                              reverse=self._sort_rev)
-                    if _check_proj(project, fltr) and has_elem(project)]
+    @contextlib.contextmanager
+    def group(self):
+        """Apply a group of commands at once: nothing else changes or saves
+        the items in between, the journal is synced and subscribers are told
+        once at the end.
+        """
+        with self.lock, self.events.held():
+            if self.journal is None:
+                yield
+            else:
+                with self.journal.grouped():
+                    yield
 
-        def _get_areas(fltr):
-            def has_elem(area):
-                fargs = dict(fltr)
-                fargs.pop('arch', None)
+    def log(self, op, *args):
+        """Record a command in the journal before it is applied. Items given
+        as arguments are stored as their ids.
+        """
+        args = [x.id if isinstance(x, Action) else x for x in args]
+        if self.journal is not None:
+            self.journal.write(op, *args)
+        if self._pool is not None:
+            parallel.record(self, op, args)
 
-                if fargs:
-                    return (any(_get_actions(area, fargs)) or
-                            any(_get_projects(area, fargs)))
+    def is_removed(self, node):
+        """Whether an item, or any item holding it, is deleted.
+        """
+        while node is not None:
+            if node.is_deleted:
                 return True
+            node = node.parent
+        return False
+
+    def needs_compact(self):
+        return self.deleted >= self.compact_threshold
+
+    def compact(self, keep=()):
+        """Remove deleted items for good, along with whatever they hold, the
+        same way saving and loading the database again would. Items in 'keep',
+        e.g. those on the screen, and their containers stay where they are,
+        so that the list shown keeps its numbers, until a later compaction.
+        Nothing else is visible, so the version stays the same. Returns the
+        number of items removed.
+        """
+        kept = set()
+        for node in keep:
+            while node is not None and node not in kept:
+                kept.add(node)
+                node = node.parent
+
+        removed = 0
+
+        def _drop(items):
+            nonlocal removed
+            if not any(x.is_deleted for x in items):
+                return items
+
+            live = []
+            for item in items:
+                if not item.is_deleted:
+                    live.append(item)
+                elif item in kept:
+                    live.append(item)
+                else:
+                    removed += self._forget(item)
+                    self.events.emit(events.removed(item))
+            return live
+
+        with self.lock:
+            # lists are replaced, not changed, as queries may be iterating
+            self.areas = _drop(self.areas)
+
+            for area in self.areas:
+                area.actions = _drop(area.actions)
+                area.projects = _drop(area.projects)
+
+                for project in area.projects:
+                    project.actions = _drop(project.actions)
+
+            # kept items wait for new deletions, and are not compacted again
+            # after every command
+            self.deleted = 0
+            if removed:
+                parallel.reset(self)
+            return removed
+
+    def copy_area(self, area):
+        """Copy of the live part of an area, which can be saved while the
+        items keep changing. Nothing but the lists is copied deeply.
+        """
+        area = copy.copy(area)
+        area.actions = [copy.copy(x) for x in _live(area.actions)]
+        area.projects = [copy.copy(x) for x in _live(area.projects)]
 
-            return [area
-                    for area
-                    in self.areas
-                    if _check_area(area, fltr) and has_elem(area)]
+        for project in area.projects:
+            project.actions = [copy.copy(x) for x in _live(project.actions)]
 
-        for area in _get_areas(args):
+        return area
+
+    def query(self, args=None):
+        """List all items in a database. Result may be filtered by applying
+        extra conditions in form of an 'args' dictionary.
+
+        The filter is compiled once and every item is visited once: an area
+        or a project is shown if it holds any action passing the filter
+        without its 'arch' condition, and each container is sorted once.
+        Large databases are filtered by several processes if 'workers' is
+        set.
+        """
+        if args is None:
+            args = {}
+
+        if self._is_parallel():
+            found = parallel.find(self, args)
+        else:
+            found = self._filter(args, self.areas)
+
+        for area, actions, projects, shown in found:
             yield area
 
-            for action in _get_actions(area, args):
+            for action in self._sorted(actions):
                 yield action
 
-            for project in _get_projects(area, args):
+            for project in self._sorted(projects):
                 yield project
 
-                for action in _get_actions(project, args):
+                for action in self._sorted(shown[project]):
                     yield action
+
+    def _filter(self, args, areas, scan=None):
+        """Yield (area, actions, projects, actions of each project) for the
+        areas to be shown, with their items in the order they are stored.
+        Actions of an area or a project are checked by 'scan', if given, e.g.
+        by one which looks up what workers found.
+        """
+        loose_args = dict(args)
+        loose_args.pop('arch', None)
+
+        check_loose, hits = (self._matcher(loose_args) if loose_args
+                             else (None, None))
+        check_area = self._check_name(args.get('area'))
+        check_proj = self._check_name(args.get('proj'))
+        area_actions = 'proj' not in args
+
+        if scan is None:
+            check_act, _ = self._matcher(args)
+
+            def scan(node):
+                return self._scan(node.actions, check_act, check_loose)
+
+        for area in areas:
+            if hits is not None and area not in hits:
+                continue
+            if not check_area(area):
+                continue
+
+            if area_actions:
+                actions, has_elem = scan(area)
+            else:
+                actions, has_elem = [], not loose_args
+
+            projects = []
+            shown = {}
+            for project in area.projects:
+                if hits is not None and project not in hits:
+                    continue
+                if not check_proj(project):
+                    continue
+
+                proj_actions, proj_has_elem = scan(project)
+                if proj_has_elem:
+                    projects.append(project)
+                    shown[project] = proj_actions
+
+            if has_elem or projects:
+                yield area, actions, projects, shown
+
+    def _scan(self, actions, check_act, check_loose):
+        """Return actions to display and whether any of them passes the
+        loose filter, if there is one.
+        """
+        shown = []
+        has_elem = check_loose is None
+
+        for action in actions:
+            if check_act(action):
+                shown.append(action)
+            if not has_elem and check_loose(action):
+                has_elem = True
+
+        return shown, has_elem
+
+    def _is_parallel(self):
+        return self.workers > 1 and \
+            len(self._ids) >= self.parallel_threshold and \
+            parallel.is_available()
+
+    def _sorted(self, items):
+        return sorted(items, key=self._sort_by, reverse=self._sort_rev)
+
+    def _matcher(self, fltr):
+        """Return a test telling whether an action passes the filter, and
+        the set of areas and projects holding such actions, or None if it is
+        not known up front.
+        """
+        tagged = None
+        dated = None
+        named = None
+
+        for k, v in fltr.items():
+            if k == 'act':
+                named = set(x for x in self._named(v)
+                            if not isinstance(x, Project))
+            elif k == 'tag':
+                tagged = set().union(*[self._tags.get(tag, ()) for tag in v])
+            elif k == 'due':
+                dated = set()
+                for due in v:
+                    dated.update(self._due_range(due))
+                break  # filters after due are never checked
+
+        check = _compile(fltr, tagged, dated, named)
+        found = [x for x in (tagged, dated, named) if x is not None]
+        if not found:
+            return check, None
+
+        hits = found[0].intersection(*found[1:])
+        return check, self._containers(hits)
+
+    def _check_name(self, texts):
+        """Test of an item name containing any of the given strings, ignoring
+        the case.
+        """
+        if texts is None:
+            return lambda node: True
+        return self._named(texts).__contains__
+
+    def _named(self, texts):
+        """Items whose name contains any of the given strings, ignoring the
+        case. Only the items having every trigram of a string are checked;
+        strings too short to have one are looked for in all the names.
+        """
+        with self.lock:
+            grams = self._name_index()
+            found = set()
+
+            for text in texts:
+                text = text.lower()
+                keys = _trigrams(text)
+                if not keys:
+                    found.update(x for x, name in self._lower.items()
+                                 if text in name)
+                    continue
+
+                postings = sorted([grams.get(x, set()) for x in keys],
+                                  key=len)
+                found.update(x for x in postings[0].intersection(*postings[1:])
+                             if text in self._lower[x])
+
+            return found
+
+    def _name_index(self):
+        """Trigrams of the names of all the items, indexed when a name filter
+        is first used and kept up to date from then on.
+        """
+        if self._grams is None:
+            self._grams = {}
+            self._lower = {}
+            for node in self._ids.values():
+                self._index_name(node)
+        return self._grams
+
+    def _index_name(self, node):
+        if self._grams is None:
+            return
+
+        self._unindex_name(node)
+        name = self._lower[node] = node.name.lower()
+        for gram in _trigrams(name):
+            self._grams.setdefault(gram, set()).add(node)
+
+    def _unindex_name(self, node):
+        name = self._lower.pop(node, None)
+        if name is not None:
+            for gram in _trigrams(name):
+                self._grams[gram].discard(node)
+
+    def _due_range(self, due):
+        """Actions whose due date passes a DateFilter, found by bisection.
+        """
+        keys = self._due_keys
+
+        if due.ordinal is None:
+            return []
+
+        left = bisect.bisect_left(keys, due.ordinal)
+        right = bisect.bisect_right(keys, due.ordinal)
+        bounds = {
+            '=': (left, right),
+            '<': (0, left),
+            '<=': (0, right),
+            '>': (right, len(keys)),
+            '>=': (left, len(keys))
+        }[due.op]
+
+        return self._due_items[bounds[0]:bounds[1]]
+
+    def _revise(self, areas):
+        for area in areas:
+            if area is not None:
+                area.revision += 1
+
+        self.version += 1
+
+    def _watch(self, op, args):
+        """Remember what a command is about to change. Returns a function
+        telling, once it is applied, what changed.
+        """
+        node = args[0]
+
+        if op == 'add':
+            return lambda item: [events.added(item)]
+        if op == 'move':
+            source = node.parent
+            return lambda item: [events.moved(node, source)]
+
+        fields = _FIELDS[op]
+        # done and arch apply to the items held too
+        nodes = list(_subtree(node)) if op in ['arch', 'done'] else [node]
+        before = [[getattr(x, f) for f in fields] for x in nodes]
+
+        def _changes(ret):
+            changes = []
+            for x, values in zip(nodes, before):
+                names = tuple(f for f, v in zip(fields, values)
+                              if getattr(x, f) != v)
+                if names:
+                    changes.append(events.changed(x, names))
+            return changes
+
+        return _changes
+
+    def _area(self, node):
+        while node is not None and not isinstance(node, Area):
+            node = node.parent
+        return node
+
+    def _containers(self, actions):
+        containers = set(action.parent for action in actions)
+        containers.update([x.parent for x in containers
+                           if not isinstance(x, Area)])
+        return containers
+
+    def _forget(self, node):
+        """Drop a removed item, and the items it holds, from the indexes.
+        Returns the number of items dropped.
+        """
+        n = 1
+        for child in getattr(node, 'projects', []) + \
+                getattr(node, 'actions', []):
+            n += self._forget(child)
+
+        self._ids.pop(node.id, None)
+        self._unindex_name(node)
+        self._unindex_tags(node)
+        self._unindex_due(node)
+        return n
+
+    def _new_id(self):
+        item_id = self._next_id
+        self._next_id += 1
+        return item_id
+
+    def _reserve_ids(self, areas):
+        """Keep ids held by items of the areas from being given to items
+        indexed before them.
+        """
+        top = 0
+        for area in areas:
+            for node in _subtree(area):
+                if node.id is not None and node.id > top:
+                    top = node.id
+        self._next_id = max(self._next_id, top + 1)
+
+    def _register(self, node, parent, item_id=None):
+        """Link an item to its parent and make it known by its id, giving it
+        a new id if it has none or the one it has is taken.
+        """
+        if item_id is not None:
+            node.id = item_id
+        elif node.id is None or node.id in self._ids:
+            node.id = self._new_id()
+
+        node.parent = parent
+        self._ids[node.id] = node
+        self._next_id = max(self._next_id, node.id + 1)
+        self._index_name(node)
+
+    def _index_area(self, area):
+        self._register(area, None)
+
+        for i, action in enumerate(area.actions):
+            action.pos = i
+            self._index_action(action, area)
+
+        for project in area.projects:
+            self._register(project, area)
+
+            for i, action in enumerate(project.actions):
+                action.pos = i
+                self._index_action(action, project)
+
+    def _index_action(self, action, parent):
+        self._register(action, parent)
+
+        for tag in action.tags:
+            self._tags.setdefault(tag, set()).add(action)
+
+        self._index_due(action)
+
+    def _unindex_tags(self, action):
+        for tag in action.tags:
+            self._tags.get(tag, set()).discard(action)
+
+    def _index_due(self, action):
+        if action.due is not None:
+            i = bisect.bisect_right(self._due_keys, action.due)
+            self._due_keys.insert(i, action.due)
+            self._due_items.insert(i, action)
+
+    def _unindex_due(self, action):
+        if action.due is None:
+            return
+
+        i = bisect.bisect_left(self._due_keys, action.due)
+        j = bisect.bisect_right(self._due_keys, action.due)
+
+        for k in range(i, j):
+            if self._due_items[k] is action:
+                del self._due_keys[k]
+                del self._due_items[k]
+                return
+
+    def _apply_add(self, parent, kind, name, item_id):
+        if kind == 'project':
+            item = Project(name)
+            parent.projects.append(item)
+        else:
+            item = Action(name)
+            item.pos = len(parent.actions)
+            parent.actions.append(item)
+
+        self._register(item, parent, item_id)
+        return item
+
+    def _apply_arch(self, node):
+        node.mark_archieved()
+
+    def _apply_clean(self, node, tags, due):
+        if tags:
+            self._unindex_tags(node)
+            node.clean_tags()
+        if due:
+            self._unindex_due(node)
+            node.clean_duedate()
+
+    def _apply_del(self, node):
+        # deleted items stay in their lists, and in the indexes, until the
+        # database is compacted
+        if not node.is_deleted:
+            self.deleted += 1
+        node.delete()
+
+    def _apply_desc(self, node, text):
+        node.description = text
+
+    def _apply_done(self, node, undo):
+        node.mark_done(undo=undo)
+
+    def _apply_due(self, node, date):
+        self._unindex_due(node)
+        node.due_date = date
+
+        # only actions are indexed, the same as when the items are loaded
+        if not isinstance(node, Project):
+            self._index_due(node)
+
+    def _apply_edit(self, node, name):
+        node.name = name
+        self._index_name(node)
+
+    def _apply_move(self, node, dest):
+        """Relink an action; it keeps its id and stays in the indexes.
+        """
+        _remove(node.parent.actions, node)
+        node.pos = len(dest.actions)
+        dest.actions.append(node)
+        node.parent = dest
+        return node
+
+    def _apply_tag(self, node, tags):
+        if not isinstance(node, Project):
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(node)
+
+        node.add_tags(tags)
+
+
+def _subtree(node):
+    yield node
+    for child in getattr(node, 'projects', []):
+        for x in _subtree(child):
+            yield x
+    for child in getattr(node, 'actions', []):
+        yield child
+
+
+def _remove(actions, action):
+    """Remove an action from the list holding it. Actions are only appended
+    to lists, and only removed by moves and compaction, so an action is at
+    the position it was placed at or closer to the front, by the number of
+    actions removed before it since.
+    """
+    i = action.pos
+    if i is None or i >= len(actions):
+        i = len(actions) - 1
+
+    while i >= 0 and actions[i] is not action:
+        i -= 1
+
+    if i < 0:
+        actions.remove(action)
+    else:
+        del actions[i]
+
+
+def _live(items):
+    return [x for x in items if not x.is_deleted]
+
+
+def _trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def _compile(fltr, tagged, dated, named):
+    """Turn a filter into a single test of an action. Filters are checked in
+    their order and a 'due' filter decides on its own, ignoring whatever comes
+    after it. Sets of tagged, dated and named actions found by the indexes
+    replace the tag, due and act filters when given.
+    """
+    tests = []
+
+    for k, v in fltr.items():
+        if k == 'act':
+            tests.append(named.__contains__)
+        elif k == 'tag':
+            if tagged is not None:
+                tests.append(tagged.__contains__)
+            else:
+                tests.append(_compile_tags(v))
+        elif k == 'due':
+            if dated is not None:
+                tests.append(dated.__contains__)
+            else:
+                tests.append(_compile_due(v))
+            break
+        elif k == 'done':
+            tests.append(_compile_flag('is_done', v))
+        elif k == 'arch':
+            tests.append(_compile_flag('is_archieved', v))
+
+    if not tests:
+        return lambda node: True
+    if len(tests) == 1:
+        return tests[0]
+
+    def check(node):
+        for test in tests:
+            if not test(node):
+                return False
+        return True
+
+    return check
+
+
+def _compile_tags(tags):
+    tags = set(tags)
+    return lambda node: not tags.isdisjoint(node.tags)
+
+
+def _compile_due(dues):
+    def check(node):
+        if node.due is None:
+            return False
+        for due in dues:
+            if due(node.due):
+                return True
+        return False
+
+    return check
+
+
+def _compile_flag(attr, values):
+    values = set(values)
+    return lambda node: getattr(node, attr) in values
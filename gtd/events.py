@@ -0,0 +1,78 @@
+import collections
+import contextlib
+
+# kind is one of 'add', 'remove', 'move', 'change' or 'reset'. 'fields' are
+# the attributes a change set, or None if they are not known, and 'source'
+# is the container an item was moved from.
+Event = collections.namedtuple('Event', 'kind node fields source')
+
+
+def added(node):
+    return Event('add', node, None, None)
+
+
+def removed(node):
+    return Event('remove', node, None, None)
+
+
+def moved(node, source):
+    return Event('move', node, None, source)
+
+
+def changed(node, fields=None):
+    return Event('change', node, fields, None)
+
+
+def reset():
+    return Event('reset', None, None, None)
+
+
+class EventBus:
+    """Tells subscribers how items changed, so that whatever they derive from
+    the items can be updated by the change instead of built again.
+
+    Subscribers are called with a list of events, right after a command is
+    applied, or once at the end of a group of commands while they are held.
+    """
+
+    def __init__(self):
+        self._subscribers = []
+        self._pending = []
+        self._held = 0
+
+    def __bool__(self):
+        """Whether anyone listens; events need not be made otherwise.
+        """
+        return bool(self._subscribers)
+
+    def subscribe(self, func):
+        self._subscribers.append(func)
+
+    def unsubscribe(self, func):
+        self._subscribers.remove(func)
+
+    def emit(self, *events):
+        if not self._subscribers:
+            return
+
+        self._pending.extend(events)
+        if not self._held:
+            self._flush()
+
+    @contextlib.contextmanager
+    def held(self):
+        """Deliver events emitted inside the block all at once, when it ends.
+        """
+        self._held += 1
+        try:
+            yield
+        finally:
+            self._held -= 1
+            if not self._held:
+                self._flush()
+
+    def _flush(self):
+        events, self._pending = self._pending, []
+        if events:
+            for func in list(self._subscribers):
+                func(events)
@@ -1,6 +1,8 @@
 import datetime
-from os import popen
+import operator
 import re
+import shutil
+import signal
 try:
     import colorama
     io_color = True
@@ -11,24 +13,41 @@ import textwrap
 
 from . import items as it
 
+_size = None  # terminal size, reset when the window is resized
+_is_resize_watched = False
+_wrappers = {}  # (width, prefix) -> TextWrapper
+_format_cache = {}  # indent -> format strings
+
+
+class DateFilter(object):
+    """Comparison of a due date ordinal against a fixed date, e.g.
+    '<= 01-02-2016'. Operator and date are kept so that the filter can be
+    inspected.
+    """
+    operators = {
+        '>=': operator.ge,
+        '<=': operator.le,
+        '>': operator.gt,
+        '<': operator.lt,
+        '=': operator.eq
+    }
+
+    def __init__(self, op, date):
+        self.op = op
+        self.date = date
+        self.ordinal = it.parse_due(date)
+
+    def __call__(self, x):
+        if x is None or self.ordinal is None:
+            return False
+        return self.operators[self.op](x, self.ordinal)
+
 
 def filter_date(line):
     pair = re.search('([<>]?=|[<>]|)\s*(.*?)$', line)
 
     if pair:
-        operator = pair.group(1)
-        date = format_date(pair.group(2))
-
-        if operator == '>=':
-            return lambda x: x >= date
-        elif operator == '<=':
-            return lambda x: x <= date
-        elif operator == '>':
-            return lambda x: x > date
-        elif operator == '<':
-            return lambda x: x < date
-        else:
-            return lambda x: x == date
+        return DateFilter(pair.group(1) or '=', format_date(pair.group(2)))
 
     return None
 
@@ -64,27 +83,99 @@ def format_date(line):
     return date.strftime('%d-%m-%Y')
 
 
+def terminal_size():
+    """Columns and lines of the terminal. It is asked for once and again only
+    after the window has been resized.
+    """
+    global _size
+
+    if _size is None:
+        _size = shutil.get_terminal_size()
+        _watch_resize()
+
+    return _size
+
+
+def _watch_resize():
+    global _is_resize_watched
+
+    if _is_resize_watched or not hasattr(signal, 'SIGWINCH'):
+        return
+
+    def _on_resize(signum, frame):
+        global _size
+        _size = None
+
+    try:
+        signal.signal(signal.SIGWINCH, _on_resize)
+        _is_resize_watched = True
+    except ValueError:
+        # signal handlers can only be set from the main thread
+        pass
+
+
 def format_description(desc, prefix='\t\t\t'):
-    rows, columns = popen('stty size', 'r').read().split()
-    if not columns:
+    sz = terminal_size().columns - len(prefix.expandtabs())
+    if sz <= 0:
         return desc
 
-    sz = int(columns) - len(prefix.expandtabs())
+    key = (sz, prefix)
+    if key not in _wrappers:
+        _wrappers[key] = textwrap.TextWrapper(width=sz,
+                                              subsequent_indent=prefix)
 
-    return textwrap.fill('"' + desc + '"', width=sz, subsequent_indent=prefix)
+    return _wrappers[key].fill('"' + desc + '"')
 
 
-def format_item(idx, item, options):
+def _init_color():
     global is_color_initialized
 
+    if io_color and not is_color_initialized:
+        colorama.init(autoreset=True)
+        is_color_initialized = True
+
+
+def _colors():
+    """Colour prefixes, or empty strings if colorama is not available. Output
+    is written in one go, so every coloured part is reset explicitly.
+    """
+    if io_color:
+        return {
+            'area': colorama.Fore.CYAN,
+            'project': colorama.Fore.GREEN,
+            'underline': colorama.Style.BRIGHT,
+            'reset': colorama.Style.RESET_ALL
+        }
+    return {'area': '', 'project': '', 'underline': '', 'reset': ''}
+
+
+def _formats(indent):
+    """Format strings of items at a given indent, built once.
+    """
+    if indent not in _format_cache:
+        colors = _colors()
+        pad = str(indent)
+
+        _format_cache[indent] = {
+            'area': '{:d}' + colors['area'] + '*** {} ***' + colors['reset'],
+            'project': '{:<' + pad + '}' + colors['project'] + '{}' +
+                       colors['reset'],
+            'underline': '\n' + ' ' * indent + colors['underline'] + '{}' +
+                         colors['reset'],
+            'action': '{:<' + pad + '}[{}] {}',
+            'details': '\n' + ' ' * indent,
+            'description': ' ' * (indent + 6)
+        }
+
+    return _format_cache[indent]
+
+
+def format_item(idx, item, options):
     ret = ''
     proj_indent = 8
     action_indent = 9
 
-    if io_color:
-        if not is_color_initialized:
-            colorama.init(autoreset=True)
-            is_color_initialized = True
+    _init_color()
 
     if isinstance(item, it.Area):
         ret = format_area(idx, item)
@@ -98,45 +189,51 @@ def format_item(idx, item, options):
     return ret
 
 
+def format_items(nodes, options, start=1):
+    """Render items numbered from 'start' into a single string, one item per
+    line, so that the whole list can be written at once.
+    """
+    lines = [format_item(i, node, options)
+             for i, node in enumerate(nodes, start)]
+    lines.append('')
+    return '\n'.join(lines)
+
+
 def format_area(idx, item):
-    return ('{:d}' + colorama.Fore.CYAN + '*** {} ***').format(idx, item.name)
+    return _formats(0)['area'].format(idx, item.name)
 
 
 def format_project(idx, item, options, indent=8):
-    if io_color:
-        proj = ('{:<' + str(indent) + '}' + colorama.Fore.GREEN + '{}').format(
-            idx, item.name)
-    else:
-        proj = ('{:<' + str(indent) + '}{}').format(idx, item.name)
+    formats = _formats(indent)
+    proj = formats['project'].format(idx, item.name)
 
     if item.due_date and ('show_due_date' in options):
         proj += ' @ ' + item.due_date
 
-    if io_color:
-        proj += '\n' + (' ' * indent) + colorama.Style.BRIGHT + \
-                ('=' * len(item.name))
-    else:
-        proj += '\n' + (' ' * indent) + ('=' * len(item.name))
+    proj += formats['underline'].format('=' * len(item.name))
 
     return proj
 
 
 def format_action(idx, item, options, indent):
-    act = ('{:<' + str(indent) + '}[{}] {}').format(
-        idx, 'X' if item.is_done else ' ', item.name)
+    formats = _formats(indent)
+    act = formats['action'].format(idx, 'X' if item.is_done else ' ',
+                                   item.name)
+
+    show_tags = 'show_tags' in options
+    show_due = 'show_due_date' in options
 
     if item.description and ('show_description' in options):
-        prefix = ' ' * (indent + 6)
+        prefix = formats['description']
         act += '\n' + prefix + \
             format_description(item.description, prefix=prefix)
 
-    if (item.tags or item.due_date) and \
-            (('show_tags' in options) or ('show_due_date' in options)):
-        act += '\n' + ' ' * indent
+    if (item.tags or item.due_date) and (show_tags or show_due):
+        act += formats['details']
 
-        if item.due_date and ('show_due_date' in options):
+        if item.due_date and show_due:
             act += '@' + item.due_date + ' '
-        if item.tags and ('show_tags' in options):
+        if item.tags and show_tags:
             act += ', '.join(['+' + str(x) for x in item.tags])
 
     return act
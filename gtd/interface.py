@@ -1,15 +1,18 @@
-import copy
+import contextlib
 import datetime
+import itertools
 import re
+import sys
 import weakref
 from builtins import input
+from io import StringIO
 from . import alias
 from . import completer as cpl
 from . import formatter as fmt
 from . import io
 from . import items as it
 from . import options as opt
-import os
+from . import screen
 
 from threading import Timer
 
@@ -18,13 +21,37 @@ try:
 except ImportError:
     print('Module readline not available.')
 
+# attributes of the items each filter tests
+_FILTER_FIELDS = {
+    'act': 'name',
+    'arch': 'is_archieved',
+    'area': 'name',
+    'done': 'is_done',
+    'due': 'due',
+    'proj': 'name',
+    'tag': 'tags'
+}
+
+# item numbers, such as '3', '3-40' or '3-40,52,60-75'
+_ITEMS = r'(\d+(?:\s*-\s*\d+)?(?:\s*,\s*\d+(?:\s*-\s*\d+)?)*)'
+
 
 class Interface:
     def __init__(self, db):
         self.db = db
         self.user_filter = self.default_filter()
+        self._view_items = None
+        self._view_iter = None
+        self._sort_fields = ('is_done',)  # None if not known
+        self._top = 1  # first item on the page, in the pager mode
+        self.screen = screen.Screen()
         self.alias = alias.Alias('alias.txt')
         self.options = opt.Options('options.txt').get()
+        self.autosave = None  # saves the file in the background, if running
+        self.db.events.subscribe(self._on_change)
+
+        if 'workers' in self.options:
+            self.db.workers = int(self.options['workers'])
 
         self.commands = [
             {
@@ -57,6 +84,12 @@ class Interface:
                 'func': self._clear,
                 'errmsg': 'Cannot clear screen',
                 'help': ''
+            }, {
+                'name': 'compact',
+                're': r'^compact$',
+                'func': self._compact,
+                'errmsg': 'Cannot compact the list',
+                'help': 'Remove deleted items for good'
             }, {
                 'name': 'del',
                 're': r'^del\s+\d+',
@@ -87,6 +120,20 @@ class Interface:
                 'func': self._edit,
                 'errmsg': '',
                 'help': 'Edit name of an action'
+            }, {
+                'name': 'find',
+                're': r'^find\s+',
+                'func': self._find,
+                'display': True,
+                'errmsg': 'Cannot find an item',
+                'help': 'Show the page starting at the next matching item'
+            }, {
+                'name': 'goto',
+                're': r'^goto\s+\d+',
+                'func': self._goto,
+                'display': True,
+                'errmsg': 'Cannot locate an item',
+                'help': 'Show the page starting at the given item'
             }, {
                 'name': 'help',
                 're': r'^help',
@@ -97,20 +144,42 @@ class Interface:
                 'name': 'list',
                 're': r'^list',
                 'func': self._list,
+                'display': True,
                 'errmsg': 'Cannot list all items',
                 'help': 'List all items'
             }, {
                 'name': 'move',
-                're': r'^move\s+\d+\s+to\s+\d+',
+                're': r'^move\s+' + _ITEMS + r'\s+to\s+\d+',
                 'func': self._move,
                 'errmsg': '',
                 'help': 'Move an action between projects/areas'
+            }, {
+                'name': 'next, n',
+                're': r'^(next|n)$',
+                'func': self._next_page,
+                'display': True,
+                'errmsg': 'No more items',
+                'help': 'Show the next page'
             }, {
                 'name': 'notify',
                 're': r'^nt',
                 'func': self._notify,
                 'errmsg': 'Cannot set a notification',
                 'help': 'Set a notification for a task.'
+            }, {
+                'name': 'pager',
+                're': r'^pager$',
+                'func': self._pager,
+                'display': True,
+                'errmsg': '',
+                'help': 'Show the list page by page or all at once'
+            }, {
+                'name': 'prev, p',
+                're': r'^(prev|p)$',
+                'func': self._prev_page,
+                'display': True,
+                'errmsg': 'Already at the first page',
+                'help': 'Show the previous page'
             }, {
                 'name': 'save',
                 're': r'^save',
@@ -121,18 +190,21 @@ class Interface:
                 'name': 'show',
                 're': r'^show',
                 'func': self._show,
+                'display': True,
                 'errmsg': '',
                 'help': 'Show/hide some of the information'
             }, {
                 'name': 'sort',
                 're': r'^sort',
                 'func': self._sort,
+                'display': True,
                 'errmsg': '',
                 'help': 'Sort current list'
             }, {
                 'name': 'select, s',
                 're': r'^(select|s)',
                 'func': self._select,
+                'display': True,
                 'errmsg': '',
                 'help': 'Filter items to display'
             }, {
@@ -151,6 +223,7 @@ class Interface:
                 'name': 'view, v',
                 're': r'^v\s+',
                 'func': self._alias,
+                'display': True,
                 'errmsg': '',
                 'help': 'Load pre-defined view'
             }, {
@@ -170,6 +243,8 @@ class Interface:
     def default_sort(self):
         self.db._sort_by = lambda x: x.is_done
         self.db._sort_rev = False
+        self._sort_fields = ('is_done',)
+        self._invalidate()
 
     def start(self):
         """Main loop of an interface that reads and parses commands.
@@ -194,49 +269,237 @@ class Interface:
 
             self._proceed_cmd(cmd)
 
+    def batch(self, lines, show=False):
+        """Run commands one per line, without showing the list between
+        them, and save the database once at the end. Empty lines and lines
+        starting with '#' are skipped. Returns the number of commands that
+        failed.
+        """
+        failed = 0
+
+        with self.db.batch():
+            for line in lines:
+                cmd = line.strip()
+
+                if not cmd or cmd.startswith('#'):
+                    continue
+                if cmd == 'quit' or cmd == 'q':
+                    break
+
+                if not self._run_cmd(cmd):
+                    failed += 1
+
+        io.save(self.db)
+
+        if show:
+            sys.stdout.write(fmt.format_items(self._view(), self.options))
+
+        return failed
+
     def _proceed_cmd(self, cmd, show=True):
-        self._clear()
-        is_cmd = False
+        """Run a command and show the list again, followed by whatever the
+        command printed.
+        """
+        output = StringIO()
+        with contextlib.redirect_stdout(output):
+            self._run_cmd(cmd)
+
+        if show:
+            self._show_query(self.user_filter, output.getvalue())
+        else:
+            sys.stdout.write(output.getvalue())
+
+    def _run_cmd(self, cmd):
+        """Dispatch a command; True if it succeeded.
+        """
 
         for op in self.commands:
             if re.search(op.get('re'), cmd):
-                is_cmd = True
                 try:
                     if not op.get('func')(cmd):
                         print(op.get('errmsg'))
-                    else:
-                        if show:
-                            self._show_query(self.user_filter)
+                        return False
+                    self._tidy()
+                    return True
                 except Exception as e:
                     print('Exception: ' + str(e))
                     print(op.get('name') + ': ' + op.get('errmsg'))
-                finally:
-                    break
+                    return False
 
-        if not is_cmd:
-            print('Unknown command: ' + cmd)
+        print('Unknown command: ' + cmd)
+        return False
 
-    def _show_query(self, args):
-        i = 0
-        for node in self.db.query(args):
-            i += 1
-            print(fmt.format_item(i, node, self.options))
+    def is_display(self, cmd):
+        """Tell whether a command is one of those changing what is shown
+        rather than the items.
+        """
+        for op in self.commands:
+            if re.search(op.get('re'), cmd):
+                return op.get('display', False)
+        return False
+
+    def _tidy(self):
+        """Fold the journal into the xml file once it grows too long, and
+        remove deleted items once there are too many of them.
+        """
+        if self.db.journal is not None and self.db.journal.is_full():
+            self._write()
+        if self.db.needs_compact():
+            self.db.compact(self._view())
+
+    def _show_query(self, args, output=''):
+        if args is not self.user_filter:
+            text = fmt.format_items(self.db.query(args), self.options)
+        elif self.options.get('pager'):
+            text = self._render_page()
+        else:
+            text = fmt.format_items(self._view(), self.options)
+
+        self.screen.update(text, output)
         return True
 
+    def _render_page(self):
+        """Render the items that fit the terminal, starting at the top of the
+        page. Only as many items as are shown are taken from the query.
+        """
+        height = self._page_height()
+        nodes = self._view(self._top)
+        self._top = max(1, min(self._top, len(nodes)))
+
+        lines = []
+        i = self._top
+        while True:
+            nodes = self._view(i)
+            if len(nodes) < i:
+                break
+
+            text = fmt.format_item(i, nodes[i - 1], self.options)
+            n_lines = text.count('\n') + 1
+            if lines and len(lines) + n_lines > height:
+                break
+
+            lines.extend(text.split('\n'))
+            i += 1
+
+        if i == self._top:
+            lines.append('-- no items --')
+        else:
+            more = len(self._view(i)) >= i
+            lines.append('-- {}-{}{} --'.format(self._top, i - 1,
+                                                 ' more' if more else ''))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def _page_height(self):
+        """Lines available for items, leaving room for the status line, a
+        line of command output and the prompt, so that the screen does not
+        scroll.
+        """
+        return max(1, fmt.terminal_size().lines - 4)
+
+    def _view(self, n=None):
+        """Items of the current list in the order they are displayed; at
+        least the first n of them, or all if n is None. Items are taken from
+        the query only as far as needed and kept until the filter, the sort
+        order or the items on the list change.
+        """
+        if self._view_items is None:
+            self._view_items = []
+            self._view_iter = self.db.query(self.user_filter)
+
+        items = self._view_items
+
+        if self._view_iter is not None and (n is None or len(items) < n):
+            if n is None:
+                items.extend(self._view_iter)
+            else:
+                items.extend(itertools.islice(self._view_iter,
+                                              n - len(items)))
+
+            if n is None or len(items) < n:
+                self._view_iter = None
+
+        return items
+
+    def _on_change(self, events):
+        """Drop the list unless the items changed only in ways it does not
+        depend on, e.g. a description or a tag when tags are not filtered.
+        Items removed by compaction are never on the list.
+        """
+        if self._view_items is None:
+            return
+
+        depends = self._view_fields()
+        for event in events:
+            if event.kind == 'remove' and self._view_iter is None:
+                continue
+            if event.kind == 'change' and event.fields is not None and \
+                    depends is not None and depends.isdisjoint(event.fields):
+                continue
+
+            self._view_items = None
+            self._view_iter = None
+            return
+
+    def _view_fields(self):
+        """Attributes deciding which items are listed and in what order, or
+        None if not known.
+        """
+        if self._sort_fields is None:
+            return None
+
+        fields = set(self._sort_fields)
+        for k in self.user_filter:
+            if k not in _FILTER_FIELDS:
+                return None
+            fields.add(_FILTER_FIELDS[k])
+        return fields
+
+    def _invalidate(self):
+        self._view_items = None
+        self._view_iter = None
+        self._top = 1
+
     def _get_item(self, n):
         """Get an n-th item from the list given a user filter is applied.
         """
-        i = 0
-        for node in self.db.query(self.user_filter):
-            i += 1
-            if i == n:
-                return weakref.ref(node)
+        nodes = self._view(n)
+        if 1 <= n <= len(nodes):
+            return weakref.ref(nodes[n - 1])
         raise IndexError('Index %d does not exist.' % n)
 
+    def _get_items(self, numbers):
+        """Get items given by their numbers, such as '3-40,52,60-75', taking
+        the list from the query only once.
+        """
+        ranges = _ranges(numbers)
+        nodes = self._view(max(last for _, last in ranges))
+
+        # ranges are checked before they are expanded, as they may be long
+        for first, last in ranges:
+            for n in (first, last):
+                if not 1 <= n <= len(nodes):
+                    raise IndexError('Index %d does not exist.' % n)
+
+        numbers = dict.fromkeys(n for first, last in ranges
+                                for n in range(first, last + 1))
+        return [nodes[n - 1] for n in numbers]
+
+    def _apply(self, op, items, *args):
+        """Apply a command to each of the items as a single group. Returns
+        whether there were any.
+        """
+        with self.db.group():
+            for item in items:
+                self.db.apply(op, item, *args)
+
+        return bool(items)
+
     def _select(self, cmd):
         """Filter mechanism.
         """
         self.user_filter = self.default_filter()
+        self._invalidate()
         tags = ['tag', 'due', 'name', 'done', 'arch', 'act', 'proj', 'area']
         tags_pattern = '(' + '|'.join(tags) + ')'
         pos = [m.start() for m in re.finditer(tags_pattern, cmd)]
@@ -270,9 +533,9 @@ class Interface:
 
     def _sort(self, cmd):
         def _sort_by_due(x):
-            if x.due_date:
-                return datetime.datetime.strptime(x.due_date, '%d-%m-%Y')
-            return datetime.datetime.now()
+            if x.due is not None:
+                return x.due
+            return datetime.date.today().toordinal()
 
         pattern = '^sort\s+(name|tag|due|name|)\s*(asc|desc|)$'
         match = re.match(pattern, cmd)
@@ -281,21 +544,23 @@ class Interface:
             print('Sorting')
             by = match.group(1)
             order = match.group(2)
+            self._invalidate()
 
             if by == '' or by is None:
                 self.default_sort()
 
+            # the order only turns the list around, the key stays
             if order == 'desc':
-                self.db._sort_by = None
                 self.db._sort_rev = True
             elif order == 'asc':
-                self.db._sort_by = None
                 self.db._sort_rev = False
 
             if by == 'due':
                 self.db._sort_by = _sort_by_due
+                self._sort_fields = ('due',)
             elif by == 'name':
                 self.db._sort_by = lambda x: x.name
+                self._sort_fields = ('name',)
 
             return True
         return False
@@ -316,23 +581,18 @@ class Interface:
     def _add(self, cmd):
         """Add action or project.
         """
-        pattern = '(add proj|add)\s+(\d+)\s+(.*?)$'
+        pattern = '(add proj|add)\s+' + _ITEMS + '\s+(.*?)$'
         match = re.match(pattern, cmd)
 
         if match:
-            item = self._get_item(int(match.group(2)))
-            name = match.group(3)
-            type_ = match.group(1)
-
-            if type_ == 'add':
-                if isinstance(item(), it.Area) or isinstance(item(),
-                                                             it.Project):
-                    item().actions.append(it.Action(name))
-                    return True
+            if match.group(1) == 'add':
+                kind, container = 'action', it.Project  # areas are projects
             else:
-                if isinstance(item(), it.Area):
-                    item().projects.append(it.Project(name))
-                    return True
+                kind, container = 'project', it.Area
+
+            parents = [x for x in self._get_items(match.group(2))
+                       if isinstance(x, container)]
+            return self._apply('add', parents, kind, match.group(3))
 
         return False
 
@@ -349,55 +609,43 @@ class Interface:
         return False
 
     def _archieve(self, cmd):
-        """Move selected item into the archieve.
+        """Move selected items into the archieve.
         """
-        match = re.search('arch\s+(\d+)(?:\s*-\s*)?(\d+)?$', cmd)
+        match = re.search('arch\s+' + _ITEMS + '$', cmd)
         if match:
-            a = int(match.group((1)))
-            b = int(match.group((2))) if match.group(2) else a
-
-            item_list = []
-
-            for i in range(a, b + 1):
-                item_list.append(self._get_item(i))
-
-            for item in item_list:
-                item().mark_archieved()
-
-            return True
+            return self._apply('arch', self._get_items(match.group(1)))
 
         return False
 
     def _clean(self, cmd):
         """Clean action's attribues - due date, tags or both.
         """
-        match = re.search('(clean|cl)\s+(\d+)', cmd)
+        match = re.search('(clean|cl)\s+' + _ITEMS, cmd)
         if match:
-            item = self._get_item(int(match.group(2)))
-
-            if cmd.find('tag') > -1:
-                item().clean_tags()
-            if cmd.find('due') > -1:
-                item().clean_duedate()
-
-            return True
+            return self._apply('clean', self._get_items(match.group(2)),
+                               cmd.find('tag') > -1, cmd.find('due') > -1)
 
         return False
 
     def _clear(self, cmd=None):
         """Clears the screen.
         """
-        os.system('cls' if os.name == 'nt' else 'clear')
+        self.screen.clear()
+        return True
+
+    def _compact(self, cmd):
+        """Remove deleted items, except those on the screen.
+        """
+        print('Removed %d deleted items' % self.db.compact(self._view()))
         return True
 
     def _edit(self, cmd):
         """Edit an item name.
         """
-        match = re.search('edit\s+(\d+)\s+(.*?)$', cmd)
+        match = re.search('edit\s+' + _ITEMS + '\s+(.*?)$', cmd)
         if match:
-            item = self._get_item(int(match.group(1)))
-            item().name = match.group(2)
-            return True
+            return self._apply('edit', self._get_items(match.group(1)),
+                               match.group(2))
 
         return False
 
@@ -405,40 +653,64 @@ class Interface:
         """delete = mark as archieved and set a is_deleted flag to True
         This way, at a program exit an item won't be saved
         """
-        pattern = 'del\s+(\d+)$'
+        pattern = 'del\s+' + _ITEMS + '$'
         match = re.match(pattern, cmd)
 
         if match:
-            item = self._get_item(int(match.group(1)))
-            item().delete()
-            return True
+            return self._apply('del', self._get_items(match.group(1)))
 
         return False
 
     def _desc(self, cmd):
         """Set a description of an item.
         """
-        match = re.search('desc\s+(\d+)\s+(.*?)$', cmd)
+        match = re.search('desc\s+' + _ITEMS + '\s+(.*?)$', cmd)
 
         if match:
-            item = self._get_item(int(match.group(1)))
-            item().description = match.group(2)
-            return True
+            return self._apply('desc', self._get_items(match.group(1)),
+                               match.group(2))
 
         return False
 
     def _due(self, cmd):
         """Set a due date for an action or a project.
         """
-        pattern = 'due\s+(\d+)\s+(.*?)$'
+        pattern = 'due\s+' + _ITEMS + '\s+(.*?)$'
         match = re.match(pattern, cmd)
 
         if match:
-            item = self._get_item(int(match.group(1)))
-            date = fmt.format_date(match.group(2))
+            items = self._get_items(match.group(1))
+            return self._apply('due', items, fmt.format_date(match.group(2)))
+
+        return False
 
-            if isinstance(item(), it.Action) or isinstance(item(), it.Project):
-                item().due_date = date
+    def _find(self, cmd):
+        """Move the page to the next item whose name contains given text.
+        """
+        match = re.search('find\s+(.*?)$', cmd)
+        if match:
+            text = match.group(1).lower()
+            i = self._top + 1
+
+            while True:
+                nodes = self._view(i)
+                if len(nodes) < i:
+                    return False
+                if text in nodes[i - 1].name.lower():
+                    self._top = i
+                    return True
+                i += 1
+
+        return False
+
+    def _goto(self, cmd):
+        """Move the page to an item of a given number.
+        """
+        match = re.search('goto\s+(\d+)', cmd)
+        if match:
+            n = int(match.group(1))
+            if 1 <= n <= len(self._view(n)):
+                self._top = n
                 return True
 
         return False
@@ -456,17 +728,16 @@ class Interface:
         """Default view - all non-archieved items.
         """
         self.user_filter = self.default_filter()
+        self._invalidate()
         return True
 
     def _mark_done(self, cmd, undo=False):
-        """Mark item as done.
+        """Mark items as done.
         """
-        match = re.search('done\s+(\d+)', cmd)
+        match = re.search('done\s+' + _ITEMS, cmd)
 
         if match:
-            item = self._get_item(int(match.group(1)))
-            item().mark_done(undo=undo)
-            return True
+            return self._apply('done', self._get_items(match.group(1)), undo)
 
         return False
 
@@ -477,22 +748,73 @@ class Interface:
 
     def _move(self, cmd):
         """Actions only.
-        Move action from one project/area to another.
+        Move actions from one project/area to another.
         """
-        match = re.search('move\s+(\d+)\s+to\s+(\d+)', cmd)
+        match = re.search('move\s+' + _ITEMS + '\s+to\s+(\d+)', cmd)
         if match:
-            item = self._get_item(int(match.group(1)))
-            dest = self._get_item(int(match.group(2)))
-
-            if isinstance(item(), it.Action):
-                if isinstance(dest(), it.Project) or isinstance(dest(),
-                                                                it.Area):
-                    dest().actions.append(copy.deepcopy(item()))
-                    item().delete()
-                    return True
+            items = self._get_items(match.group(1))
+            dest = self._get_item(int(match.group(2)))()
+
+            if not isinstance(dest, it.Project) or self.db.is_removed(dest):
+                return False
+
+            # projects and areas are actions too, but cannot be moved
+            return self._apply('move', [
+                x for x in items
+                if not isinstance(x, it.Project) and not self.db.is_removed(x)
+            ], dest)
 
         return False
 
+    def _next_page(self, cmd):
+        """Move the page down by the number of items shown.
+        """
+        height = self._page_height()
+        i = self._top
+        lines = 0
+
+        while True:
+            nodes = self._view(i)
+            if len(nodes) < i:
+                return False
+
+            lines += self._item_height(i, nodes[i - 1])
+            if lines > height and i > self._top:
+                break
+            i += 1
+
+        self._top = i
+        return True
+
+    def _prev_page(self, cmd):
+        """Move the page up so that it ends right above the current one.
+        """
+        if self._top <= 1:
+            return False
+
+        height = self._page_height()
+        nodes = self._view(self._top)
+        i = self._top - 1
+        lines = self._item_height(i, nodes[i - 1])
+
+        while i > 1:
+            lines += self._item_height(i - 1, nodes[i - 2])
+            if lines > height:
+                break
+            i -= 1
+
+        self._top = i
+        return True
+
+    def _item_height(self, i, node):
+        return fmt.format_item(i, node, self.options).count('\n') + 1
+
+    def _pager(self, cmd):
+        """Toggle between showing the list page by page and all at once.
+        """
+        self.options['pager'] = not self.options.get('pager')
+        return True
+
     def _notify(self, cmd):
         pattern = ''
 
@@ -500,24 +822,41 @@ class Interface:
         """Save database to a file.
         """
         print('Saving')
-        io.save(self.db)
+        self._write()
         return False
 
+    def _write(self):
+        """Save the database, on the autosave worker if it is running, so
+        that the prompt does not wait for the file.
+        """
+        if self.autosave is not None and self.autosave.is_running():
+            self.autosave.request()
+        else:
+            io.save(self.db)
+
     def _tag(self, cmd):
-        """Apply tags to an action.
+        """Apply tags to actions.
         Tags may be given as a comma-separated list.
         """
-        pattern = 'tag\s+(\d+)\s+(.*?)$'
+        pattern = 'tag\s+' + _ITEMS + '\s+(.*?)$'
         match = re.match(pattern, cmd)
 
         if match:
-            item = self._get_item(int(match.group(1)))
-
-            if isinstance(item(), it.Action):
-                tags = match.group(2)
-                tags = tags.split(' ')
-                for tag in tags:
-                    item().tags.append(tag)
-                return True
+            return self._apply('tag', self._get_items(match.group(1)),
+                               match.group(2).split(' '))
 
         return False
+
+
+def _ranges(text):
+    """Ranges of item numbers given by a list such as '3-40,52,60-75', as
+    (first, last) pairs in their order.
+    """
+    ranges = []
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        first = int(first)
+        last = int(last) if last else first
+        ranges.append((min(first, last), max(first, last)))
+
+    return ranges
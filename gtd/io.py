@@ -3,14 +3,27 @@ try:
     import xml.etree.cElementTree as ET
 except ImportError:
     import xml.etree.ElementTree as ET
-import xml.dom.minidom  # just to prettify the output
+from . import coldb
 from . import db
+import copy
+import hashlib
+from io import StringIO
 import os
+import pickle
 from . import items as it
+from . import journal
+from . import sqldb
 import sys
 import imp
+import weakref
 
 _db_file_name = ''
+_CACHE_VERSION = 7
+_CHUNK = 1 << 20
+# file name -> (size and mtime of the file, and of its cache) as last written
+_files = {}
+# area -> (revision, entry of _files, byte ranges of its xml and its pickle)
+_written = weakref.WeakKeyDictionary()
 _EMPTY_DB = """<?xml version="1.0" encoding="utf-8"?>
 <data>
     <area name="Inbox"/>
@@ -22,69 +35,316 @@ if sys.version_info < (3, 4):
 
 
 def save(database, file_name=None):
-    """Add save_are, save_project,...  fncs insidethis one
+    """Write the database into an indented xml file in a single pass over
+    areas, projects and actions. Areas which have not changed since they were
+    last written are not serialized again, and nothing is written at all if
+    the database has not changed since it was loaded or saved.
     """
     if not file_name:
+        if isinstance(database, sqldb.SQLDataBase):
+            database.commit()
+            return
         file_name = _db_file_name
 
-    data = ET.Element('data')
+    log = database.journal
+    if log is not None and log.snapshot != file_name:
+        log = None
 
-    _save_data(data, database)
+    with database.save_lock, database.lock:
+        if log is not None and not database.is_dirty:
+            return
 
-    fOut = open(file_name, 'wb')
-    fOut.write(_prettify(ET.tostring(data, encoding='utf-8', method='xml')))
-    fOut.close()
+        write(snapshot(database, file_name, copy=False), file_name,
+              log.seq if log is not None else 0)
 
+        if log is not None:
+            log.truncate(log.seq)
+            database.mark_saved()
+
+
+def snapshot(database, file_name, copy=True):
+    """Live areas of a database as (area, revision, content) triples, where
+    content tells where an area which has not changed since it was written
+    to the file is found in it, or else is the area to be serialized, copied
+    if 'copy' is set. To be called holding the database lock.
+    """
+    parts = []
+    stamp = _files.get(file_name)
+    if stamp is not None and _stat(file_name) != stamp[0]:
+        stamp = None  # changed by someone else
 
-def _save_data(data, database):
     for area in database:
-        _save_area(data, area)
+        if area.is_deleted:
+            continue
 
+        written = _written.get(area)
+        if stamp is not None and written is not None and \
+                written[0] == area.revision and written[1] is stamp:
+            parts.append((area, area.revision, written))
+        else:
+            parts.append((area, area.revision,
+                          database.copy_area(area) if copy else area))
 
-def _save_area(data, area):
-    if not area.is_deleted:
-        area_elem = ET.SubElement(data, 'area', area.attributes())
+    return parts
 
-        for proj in area.projects:
-            _save_project(area_elem, proj)
 
-        for task in area.actions:
-            _save_action(area_elem, task)
+def write(parts, file_name, seq=0):
+    """Write a snapshot into a file atomically, through a temporary file
+    which replaces the old one once it is complete. 'seq' is the last journal
+    record the snapshot contains. Areas are written one by one, and those
+    which have not changed are copied from the old file.
+
+    The binary snapshot next to the file is refreshed as well, so that the
+    next load does not parse the xml. It is given up if pickles of the
+    areas copied are not known.
+    """
+    header = {'journal': str(seq)} if seq else {}
+    cache_name = file_name + '.cache'
+    stamp = _files.get(file_name)
+    spans = []
+    digest = hashlib.sha1()
+
+    cOut = cOld = fOld = None
+    if stamp is None or stamp[1] is None or _stat(cache_name) == stamp[1]:
+        try:
+            cOut = open(cache_name + '.tmp', 'wb')
+        except OSError:
+            pass
+
+    tmp_name = file_name + '.tmp'
+
+    try:
+        with open(tmp_name, 'wb') as fOut:
+            out = StringIO()
+            out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            _open_tag(out, 0, 'data', header, parts)
+            _put(fOut, digest, out.getvalue())
+
+            for area, revision, content in parts:
+                cache_span = None
+
+                if isinstance(content, it.Area):
+                    out = StringIO()
+                    _save_area(out, content)
+                    xml_span = _put(fOut, digest, out.getvalue())
+                    if cOut is not None:
+                        cache_span = _dump_area(cOut, content)
+                else:
+                    if fOld is None:
+                        fOld = open(file_name, 'rb')
+                    xml_span = _copy(fOld, fOut, content[2], digest)
+
+                    if cOut is not None and content[3] is None:
+                        cOut = _drop_cache(cOut)
+                    elif cOut is not None:
+                        if cOld is None:
+                            cOld = open(cache_name, 'rb')
+                        cache_span = _copy(cOld, cOut, content[3])
+
+                spans.append((area, revision, xml_span, cache_span))
+
+            out = StringIO()
+            _close_tag(out, 0, 'data', parts)
+            _put(fOut, digest, out.getvalue())
+            fOut.flush()
+            os.fsync(fOut.fileno())
+    except BaseException:
+        if cOut is not None:
+            _drop_cache(cOut)
+        raise
+    finally:
+        for f in [fOld, cOld]:
+            if f is not None:
+                f.close()
+
+    os.replace(tmp_name, file_name)
+    xml_stat = _stat(file_name)
+    cache_stat = None
+
+    if cOut is not None:
+        try:
+            key = xml_stat + (digest.hexdigest(),)
+            with cOut:
+                _close_cache(cOut, key, header, len(parts))
+            os.replace(cache_name + '.tmp', cache_name)
+            cache_stat = _stat(cache_name)
+        except (OSError, pickle.PicklingError):
+            pass
+
+    stamp = _files[file_name] = (xml_stat, cache_stat)
+    for area, revision, xml_span, cache_span in spans:
+        _written[area] = (revision, stamp, xml_span,
+                          cache_span if cache_stat is not None else None)
+
+
+def _drop_cache(cOut):
+    cOut.close()
+    try:
+        os.remove(cOut.name)
+    except OSError:
+        pass
+
+
+def _put(fOut, digest, text):
+    """Write text, returning the byte range it takes in the file.
+    """
+    data = text.encode('utf-8')
+    start = fOut.tell()
+    fOut.write(data)
+    digest.update(data)
+    return start, start + len(data)
+
 
+def _copy(fIn, fOut, span, digest=None):
+    """Copy a byte range from one file to another, returning the range it
+    takes in the other file.
+    """
+    start = fOut.tell()
+    fIn.seek(span[0])
+    left = span[1] - span[0]
+
+    while left > 0:
+        data = fIn.read(min(left, _CHUNK))
+        if not data:
+            raise OSError('File changed while it was copied')
+        fOut.write(data)
+        if digest is not None:
+            digest.update(data)
+        left -= len(data)
+
+    return start, fOut.tell()
+
+
+def _stat(file_name):
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _dump_area(fOut, area):
+    """Pickle the live part of an area the way iterload() builds it, with
+    no links to parents and nothing shared with the items in use. Returns
+    the byte range the pickle takes in the file.
+    """
+    def _detach(item):
+        item = copy.copy(item)
+        item.parent = None
+        return item
+
+    area = _detach(area)
+    area.revision = 0
+    area.actions = [_detach(x) for x in area.actions if not x.is_deleted]
+    area.projects = [_detach(x) for x in area.projects if not x.is_deleted]
+
+    for project in area.projects:
+        project.actions = [_detach(x) for x in project.actions
+                           if not x.is_deleted]
+        # flags of a project are read after its actions and passed on to them
+        if project.is_done:
+            project.mark_done()
+        if project.is_archieved:
+            project.mark_archieved()
+
+    start = fOut.tell()
+    pickle.dump(area, fOut, protocol=pickle.HIGHEST_PROTOCOL)
+    return start, fOut.tell()
+
+
+def _save_area(out, area):
+    projects = [proj for proj in area.projects if not proj.is_deleted]
+    tasks = [task for task in area.actions if not task.is_deleted]
+    children = projects or tasks
+
+    _open_tag(out, 1, 'area', area.attributes(), children)
+    for proj in projects:
+        _save_project(out, proj)
+    for task in tasks:
+        _save_action(out, task, 2)
+    _close_tag(out, 1, 'area', children)
+
+
+def _save_project(out, proj):
+    tasks = [task for task in proj.actions if not task.is_deleted]
+    children = proj.description or proj.due is not None or tasks
+
+    _open_tag(out, 2, 'project', proj.attributes(), children)
+    if proj.description:
+        _text_tag(out, 3, 'description', proj.description)
+    if proj.due is not None:
+        _text_tag(out, 3, 'due', proj.due_date)
+    for task in tasks:
+        _save_action(out, task, 3)
+    _close_tag(out, 2, 'project', children)
+
+
+def _save_action(out, task, depth):
+    children = task.description or task.tags or task.due is not None
+
+    _open_tag(out, depth, 'action', task.attributes(), children)
+    if task.description:
+        _text_tag(out, depth + 1, 'description', task.description)
+    for tag_name in task.tags:
+        _text_tag(out, depth + 1, 'tag', tag_name)
+    if task.due is not None:
+        _text_tag(out, depth + 1, 'due', task.due_date)
+    _close_tag(out, depth, 'action', children)
+
+
+def _escape(data):
+    """Escape text and attribute values the same way minidom does.
+    """
+    return str(data).replace('&', '&amp;').replace('<', '&lt;').replace(
+        '"', '&quot;').replace('>', '&gt;')
 
-def _save_project(elem, proj):
-    if not proj.is_deleted:
-        proj_elem = ET.SubElement(elem, 'project', proj.attributes())
 
-        if proj.description:
-            desc = ET.SubElement(proj_elem, 'description')
-            desc.text = proj.description
-        if proj.due_date:
-            due = ET.SubElement(proj_elem, 'due')
-            due.text = proj.due_date
+def _open_tag(out, depth, tag, attrib, has_children):
+    out.write('\t' * depth + '<' + tag)
+    for k, v in attrib.items():
+        out.write(' ' + k + '="' + _escape(v) + '"')
+    out.write('>\n' if has_children else '/>\n')
 
-        for task in proj.actions:
-            _save_action(proj_elem, task)
 
+def _close_tag(out, depth, tag, has_children):
+    if has_children:
+        out.write('\t' * depth + '</' + tag + '>\n')
 
-def _save_action(elem, task):
-    if not task.is_deleted:
-        task_elem = ET.SubElement(elem, 'action', task.attributes())
 
-        if task.description:
-            desc = ET.SubElement(task_elem, 'description')
-            desc.text = task.description
-        if task.tags:
-            for tag_name in task.tags:
-                tag = ET.SubElement(task_elem, 'tag')
-                tag.text = tag_name
-        if task.due_date:
-            due = ET.SubElement(task_elem, 'due')
-            due.task_elem = task.due_date
+def _text_tag(out, depth, tag, text):
+    if text:
+        out.write('\t' * depth + '<' + tag + '>' + _escape(text) +
+                  '</' + tag + '>\n')
+    else:
+        out.write('\t' * depth + '<' + tag + '/>\n')
 
 
-def load(file_name):
+def load(file_name, backend='xml'):
+    """Load a database from a file. The 'xml' backend keeps items in memory
+    and writes changes into a journal next to the xml file, the 'columns'
+    backend does the same and keeps attributes of actions in columns as
+    well, for filtering long lists. The 'sqlite' backend keeps items in an
+    SQLite database and pushes queries down to it. Given an xml file, it
+    opens the database next to it, e.g. tasks.db for tasks.xml, which is
+    filled with the items of the xml file when it is created.
+    """
     global _db_file_name
+
+    if backend == 'sqlite':
+        if os.path.splitext(file_name)[1] != '.xml':
+            _db_file_name = file_name
+            return sqldb.load(file_name)
+
+        db_name = os.path.splitext(file_name)[0] + '.db'
+        source = None
+        if not os.path.isfile(db_name) and os.path.isfile(file_name):
+            source = load(file_name)
+            source.journal.close()
+        _db_file_name = db_name
+        return sqldb.load(db_name, source)
+    elif backend not in ['xml', 'columns']:
+        raise ValueError('Unknown storage backend: %s' % backend)
+
     _db_file_name = file_name
 
     if not os.path.isfile(file_name):
@@ -92,18 +352,60 @@ def load(file_name):
         fOut.write(_EMPTY_DB)
         fOut.close()
 
-    tasks_tree = ET.parse(file_name).getroot()
-    database = db.DataBase()
-    _eat_data(database, tasks_tree.iter())
+    if backend == 'columns':
+        database = coldb.ColumnDataBase()
+    else:
+        database = db.DataBase()
+    header = {}
+
+    database.extend(_load_cached(file_name, header))
+    database.mark_saved()
+
+    log = journal.Journal(file_name)
+    log.replay(database, int(header.get('journal', 0)))
+    database.journal = log
 
     return database
 
 
-def _prettify(xml_string):
-    """Return a pretty-printed XML string for the xml.
+def iterload(file_name, header=None):
+    """Parse an xml file incrementally and yield every area as soon as its
+    closing tag has been read, so that the first areas may be used while the
+    rest of the file is still being parsed. Consumed elements are cleared on
+    the way and never build up into a full tree.
+
+    Attributes of the root element are copied into 'header' if given.
     """
-    return xml.dom.minidom.parseString(xml_string).toprettyxml(
-        encoding='UTF-8')
+    root = None
+    stack = []  # (element, item) pairs of the currently open items
+
+    for event, node in ET.iterparse(file_name, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = node
+                if header is not None:
+                    header.update(node.attrib)
+            else:
+                _eat_start(stack, node)
+            continue
+
+        if not stack or stack[-1][0] is not node:
+            _eat_text(stack, node)
+            continue
+
+        _, item = stack.pop()
+
+        if isinstance(item, it.Area):
+            root.clear()
+            yield item
+        else:
+            _eat_attributes(item, node)
+            node.clear()
+
+            if isinstance(item, it.Project):
+                stack[-1][1].projects.append(item)
+            else:
+                stack[-1][1].actions.append(item)
 
 
 def _eat_attributes(object, node):
@@ -115,48 +417,98 @@ def _eat_attributes(object, node):
             object.mark_archieved()
 
 
-def _eat_data(database, items):
-    for node in items:
-        if node.tag == 'area':
-            area = it.Area(node.attrib.get('name'))
-            _eat_area(area, node)
-            database.append(area)
+def _load_cached(file_name, header):
+    """Return areas from the binary snapshot kept next to the xml file, or
+    parse the xml file and refresh the snapshot if it is out of date.
+    """
+    cache_name = file_name + '.cache'
+    key = _file_key(file_name)
+
+    try:
+        with open(cache_name, 'rb') as fIn:
+            fIn.seek(-8, os.SEEK_END)
+            size = int.from_bytes(fIn.read(8), 'little')
+            fIn.seek(-8 - size, os.SEEK_END)
+            version, cache_key, cache_header, count = \
+                pickle.loads(fIn.read(size))
+
+            if version == _CACHE_VERSION and cache_key == key:
+                fIn.seek(0)
+                areas = [pickle.load(fIn) for _ in range(count)]
+                header.update(cache_header)
+                return areas
+    except Exception:
+        pass
+
+    areas = list(iterload(file_name, header))
+
+    try:
+        tmp_name = cache_name + '.tmp'
+        with open(tmp_name, 'wb') as fOut:
+            for area in areas:
+                pickle.dump(area, fOut, protocol=pickle.HIGHEST_PROTOCOL)
+            _close_cache(fOut, key, header, len(areas))
+        os.replace(tmp_name, cache_name)
+    except (OSError, pickle.PicklingError):
+        pass
+
+    return areas
+
+
+def _close_cache(fOut, key, header, count):
+    """End pickled areas with what they were made from, and the size of
+    that, so that it is read first.
+    """
+    trailer = pickle.dumps((_CACHE_VERSION, key, header, count),
+                           protocol=pickle.HIGHEST_PROTOCOL)
+    fOut.write(trailer)
+    fOut.write(len(trailer).to_bytes(8, 'little'))
+
+
+def _file_key(file_name):
+    """Identify the content of a file by its size, mtime and hash.
+    """
+    stat = os.stat(file_name)
+    digest = hashlib.sha1()
+
+    with open(file_name, 'rb') as fIn:
+        for chunk in iter(lambda: fIn.read(1 << 20), b''):
+            digest.update(chunk)
+
+    return stat.st_size, stat.st_mtime_ns, digest.hexdigest()
+
 
+def _eat_start(stack, node):
+    parent = stack[-1][1] if stack else None
 
-def _eat_area(area, items):
-    for node in items:
-        if node.tag == 'project':
-            project = it.Project(node.attrib.get('name'))
-            _eat_project(project, node)
-            _eat_attributes(project, node)
-            area.projects.append(project)
+    if node.tag == 'area':
+        item = it.Area(node.attrib.get('name'))
+    elif node.tag == 'project' and isinstance(parent, it.Area):
+        item = it.Project(node.attrib.get('name'))
+    elif node.tag == 'action' and isinstance(parent, it.Project):
+        item = it.Action(node.attrib.get('name'))
+    else:
+        return
 
-        elif node.tag == 'action':
-            _process_action(area, node)
+    item_id = node.attrib.get('id')
+    if item_id is not None and item_id.isdigit():
+        item.id = int(item_id)
 
+    stack.append((node, item))
 
-def _eat_project(project, items):
-    for node in items:
-        if node.tag == 'description':
-            project.description = node.text
-        elif node.tag == 'action':
-            _process_action(project, node)
-        elif node.tag == 'due':
-            project.due_date = node.text
 
+def _eat_text(stack, node):
+    if not stack:
+        return
 
-def _process_action(object, node):
-    action = it.Action(node.attrib.get('name'))
-    _eat_action(action, node)
-    _eat_attributes(action, node)
-    object.actions.append(action)
+    item = stack[-1][1]
 
+    if isinstance(item, it.Area):
+        return
 
-def _eat_action(action, items):
-    for node in items:
-        if node.tag == 'description':
-            action.description = node.text
-        if node.tag == 'tag':
-            action.tags.append(node.text)
-        if node.tag == 'due':
-            action.due_date = node.text
+    if node.tag == 'description':
+        item.description = node.text
+    elif node.tag == 'due':
+        item.due_date = node.text
+    elif node.tag == 'tag' and not isinstance(item, it.Project):
+        item.add_tags([node.text])
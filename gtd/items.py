@@ -1,15 +1,60 @@
+import datetime
+import re
+import sys
+
+_DATE_PATTERN = re.compile(r'(\d{1,2})[\\/:\s\.-](\d{1,2})[\\/:\s\.-](\d{4})')
+
+
+def parse_due(text):
+    """Convert a 'dd-mm-yyyy' date into a day ordinal; None if there is no
+    valid date in the text.
+    """
+    match = _DATE_PATTERN.search(text) if text else None
+    if not match:
+        return None
+
+    day, month, year = [int(x) for x in match.groups()]
+    try:
+        return datetime.date(year, month, day).toordinal()
+    except ValueError:
+        return None
+
+
+def format_due(ordinal):
+    if ordinal is None:
+        return None
+    return datetime.date.fromordinal(ordinal).strftime('%d-%m-%Y')
+
+
+def intern_tags(tags):
+    """Tags as a tuple of interned strings, as the same few tags repeat
+    over many actions.
+    """
+    return tuple(sys.intern(tag) if isinstance(tag, str) else tag
+                 for tag in tags)
+
+
 class Action(object):
     """Define basic building block - the action.
+    Due date is kept as a day ordinal in 'due', so that it compares and sorts
+    without being parsed again. Tags are kept in a tuple, see intern_tags().
     """
+    __slots__ = ('id', 'parent', 'pos', 'name', 'description', 'is_done',
+                 'is_archieved', 'is_deleted', 'due', 'notify_at', 'tags',
+                 '__weakref__')
+
     def __init__(self, name, description=''):
+        self.id = None
+        self.parent = None
+        self.pos = None  # position in the list of the parent, see DataBase
         self.name = name
         self.description = description
         self.is_done = False
         self.is_archieved = False
         self.is_deleted = False
-        self.due_date = None
+        self.due = None
         self.notify_at = None
-        self.tags = []
+        self.tags = ()
 
     def __repr__(self):
         return 'Action() ' + self.name
@@ -18,21 +63,35 @@ class Action(object):
         return '\t\tAction: ' + self.name + ', [' + self.description + ']'
 
     def attributes(self):
-        attr = {
-            'name': self.name,
-            'done': str(self.is_done),
-            'archieved': str(self.is_archieved)
-        }
+        attr = {}
+        if self.id is not None:
+            attr['id'] = str(self.id)
+
+        attr['name'] = self.name
+        attr['done'] = str(self.is_done)
+        attr['archieved'] = str(self.is_archieved)
+
         if self.notify_at:
             attr['notification'] = '{:%Y.%m.%d %H:%M}'.format(self.notify_at)
 
         return attr
 
+    def add_tags(self, tags):
+        self.tags = self.tags + intern_tags(tags)
+
     def clean_tags(self):
-        self.tags = []
+        self.tags = ()
+
+    @property
+    def due_date(self):
+        return format_due(self.due)
+
+    @due_date.setter
+    def due_date(self, text):
+        self.due = parse_due(text)
 
     def clean_duedate(self):
-        self.due_date = None
+        self.due = None
 
     def mark_done(self, undo=False):
         if undo:
@@ -68,6 +127,8 @@ class Action(object):
 class Project(Action):
     """Project derives from Action class and is a collection of actions.
     """
+    __slots__ = ('actions',)
+
     def __init__(self, name, description=''):
         super(Project, self).__init__(name, description)
         self.actions = []
@@ -115,9 +176,12 @@ class Project(Action):
 class Area(Project):
     """Area is a collection of both projects and actions.
     """
+    __slots__ = ('projects', 'revision')
+
     def __init__(self, name):
         super(Area, self).__init__(name, description='')
         self.projects = []
+        self.revision = 0  # bumped whenever the area or its items change
 
     def __repr__(self):
         return 'Area() ' + self.name
@@ -126,9 +190,12 @@ class Area(Project):
         return 'Area: ' + self.name
 
     def attributes(self):
-        return {
-            'name': self.name
-        }
+        attr = {}
+        if self.id is not None:
+            attr['id'] = str(self.id)
+
+        attr['name'] = self.name
+        return attr
 
     def mark_done(self, undo=False):
         if undo:
@@ -0,0 +1,160 @@
+import contextlib
+import json
+import os
+
+
+class Journal:
+    """Append-only log of commands applied on top of the last saved snapshot.
+
+    Every record is numbered. A snapshot remembers the number of the last
+    record it contains, so replaying the journal after a crash never applies
+    a change twice.
+    """
+
+    def __init__(self, snapshot, threshold=500):
+        self.snapshot = snapshot
+        self.file_name = snapshot + '.journal'
+        self.threshold = threshold
+        self.seq = 0
+        self.count = 0
+        self._file = None
+        self._is_suspended = False
+        self._is_grouped = False
+        self._end = 0  # offset after the last complete record read
+
+    def __len__(self):
+        return self.count
+
+    def is_full(self):
+        return self.count >= self.threshold
+
+    def write(self, op, *args):
+        """Append a record and force it to the disk.
+        """
+        if self._is_suspended:
+            return
+
+        if self._file is None:
+            self._file = open(self.file_name, 'a', encoding='utf-8')
+
+        self.seq += 1
+        self.count += 1
+        self._file.write(json.dumps([self.seq, op] + list(args)) + '\n')
+        if not self._is_grouped:
+            self.sync()
+
+    def sync(self):
+        """Force records written so far to the disk.
+        """
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def replay(self, database, base=0):
+        """Apply all records newer than the snapshot to a database which is
+        not logging into this journal yet.
+        """
+        self.seq = base
+        self.count = 0
+
+        for seq, op, args in self._read():
+            if seq > base:
+                _apply(database, op, args)
+                self.seq = seq
+                self.count += 1
+
+        self._cut()
+
+    def truncate(self, seq):
+        """Drop records already folded into a snapshot.
+        """
+        self.close()
+        records = [r for r in self._read() if r[0] > seq]
+        self.count = len(records)
+
+        if not records:
+            if os.path.isfile(self.file_name):
+                os.remove(self.file_name)
+            return
+
+        tmp_name = self.file_name + '.tmp'
+        with open(tmp_name, 'w', encoding='utf-8') as fOut:
+            for s, op, args in records:
+                fOut.write(json.dumps([s, op] + args) + '\n')
+            fOut.flush()
+            os.fsync(fOut.fileno())
+        os.replace(tmp_name, self.file_name)
+
+    @contextlib.contextmanager
+    def suspended(self):
+        """Skip writing records, e.g. while a batch of commands is applied
+        that ends with saving the snapshot.
+        """
+        self._is_suspended = True
+        try:
+            yield
+        finally:
+            self._is_suspended = False
+
+    @contextlib.contextmanager
+    def grouped(self):
+        """Force records of a group of commands to the disk all at once,
+        when the group ends.
+        """
+        self._is_grouped = True
+        try:
+            yield
+        finally:
+            self._is_grouped = False
+            self.sync()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _cut(self):
+        """Drop a torn write at the end of the log, so that new records are
+        not appended to it and lost along with it.
+        """
+        if os.path.isfile(self.file_name) and \
+                os.path.getsize(self.file_name) > self._end:
+            with open(self.file_name, 'r+b') as fOut:
+                fOut.truncate(self._end)
+                fOut.flush()
+                os.fsync(fOut.fileno())
+
+    def _read(self):
+        """Yield records of the log. Only the last one may be incomplete, as
+        left by a torn write; a broken record followed by others is an
+        error, and the log is not cut.
+        """
+        self._end = 0
+        if not os.path.isfile(self.file_name):
+            return
+
+        with open(self.file_name, 'rb') as fIn:
+            for line in fIn:
+                if not line.endswith(b'\n'):
+                    break  # torn write at the end of the log
+
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    raise ValueError('Broken record in %s at byte %d' %
+                                     (self.file_name, self._end))
+                self._end += len(line)
+                yield record[0], record[1], record[2:]
+
+
+def _apply(database, op, args):
+    try:
+        args[0] = database.node(args[0])
+        if op == 'move':
+            args[1] = database.node(args[1])
+    except KeyError:
+        # deleted items stay in memory after they are saved, but changes of
+        # them never make it into the file
+        return
+
+    database.apply(op, *args)
@@ -0,0 +1,182 @@
+import multiprocessing
+import threading
+
+from . import events
+
+MAX_DELTAS = 1000  # commands sent to the workers before they are forked again
+
+_database = None  # database the workers were forked with
+_applied = 0  # commands a worker has applied since it was forked
+
+
+def is_available():
+    """Workers are forked, so that they share the items with the process
+    which started them instead of receiving a copy.
+    """
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def find(database, args):
+    """Filter areas of a database by its pool of workers, each of them
+    checking a run of about the same number of actions. A long list of
+    actions is split between several runs. Areas and projects to show are
+    told from the results by DataBase._filter(), so they come in the same
+    order.
+
+    Every worker compiles the filter on its own, so there is a single run
+    per worker. Names are indexed before the workers are forked, so that
+    they share the index as well.
+    """
+    if any(k in args for k in ['act', 'proj', 'area']):
+        database._name_index()
+
+    with database.lock:
+        pool = _pool(database)
+        deltas = list(database._pool_deltas)
+        containers, runs = _runs(database.areas, database.workers)
+        parts = pool.starmap(_scan, [(deltas, args, run) for run in runs])
+
+    ids = database._ids
+    results = {}
+    for run, part in zip(runs, parts):
+        for (i, _, _), (shown, has_elem) in zip(run, part):
+            node = containers[i]
+            actions, found = results.get(node, ([], False))
+            results[node] = (actions + [ids[x] for x in shown],
+                             found or has_elem)
+
+    loose = any(k != 'arch' for k in args)
+
+    def _results(node):
+        return results.get(node, ([], not loose))
+
+    return database._filter(args, database.areas, _results)
+
+
+def record(database, op, args):
+    """Keep a command, with items given by ids, for the workers to apply
+    before they filter the items again. Once there are too many of them,
+    the workers are forked again instead.
+    """
+    if len(database._pool_deltas) < MAX_DELTAS:
+        database._pool_deltas.append((op, args))
+    else:
+        database._pool_state = None
+
+
+def reset(database):
+    """Have the workers forked again, after a change they cannot apply.
+    """
+    database._pool_state = None
+
+
+def close(database):
+    if database._pool is not None:
+        database._pool.terminate()
+        database._pool = None
+        database._pool_state = None
+        database._pool_deltas = []
+
+
+def _pool(database):
+    """Pool of workers forked from the items as they were before the
+    commands kept since then, with the names indexed or not. Changes made
+    other than by commands, e.g. by touch(), do not match the version.
+    """
+    global _database
+
+    state = (database.version - len(database._pool_deltas),
+             database.workers, database._grams is not None)
+    if database._pool is not None and database._pool_state == state:
+        return database._pool
+
+    close(database)
+
+    # forked holding the lock, so that no other thread holds it in workers
+    _database = database
+    try:
+        context = multiprocessing.get_context('fork')
+        with database.lock:
+            database._pool = context.Pool(database.workers, _init)
+    finally:
+        _database = None
+
+    database._pool_state = (database.version, database.workers,
+                            database._grams is not None)
+    return database._pool
+
+
+def _init():
+    """Detach the copy of the database in a worker from the journal and the
+    subscribers of the one it was forked from.
+    """
+    _database.journal = None
+    _database.events = events.EventBus()
+    _database.lock = threading.RLock()
+
+
+def _scan(deltas, args, run):
+    """Check actions of a run of containers in a worker, after applying
+    the commands it has not seen yet. Returns ids of the actions to show and
+    whether any of them passes the filter regardless of 'arch', for every
+    part of the run.
+    """
+    global _applied
+
+    for op, ids in deltas[_applied:]:
+        ids = list(ids)
+        ids[0] = _database.node(ids[0])
+        if op == 'move':
+            ids[1] = _database.node(ids[1])
+        _database.apply(op, *ids)
+    _applied = len(deltas)
+
+    loose_args = dict(args)
+    loose_args.pop('arch', None)
+
+    check_act, _ = _database._matcher(args)
+    check_loose = _database._matcher(loose_args)[0] if loose_args else None
+    containers = list(_containers(_database.areas))
+
+    part = []
+    for i, start, stop in run:
+        shown, has_elem = _database._scan(containers[i].actions[start:stop],
+                                          check_act, check_loose)
+        part.append(([x.id for x in shown], has_elem))
+    return part
+
+
+def _containers(areas):
+    for area in areas:
+        yield area
+        for project in area.projects:
+            yield project
+
+
+def _runs(areas, n):
+    """Split actions of all the areas and projects into at most about n
+    runs of similar size, as (container, start, stop) slices of their lists.
+    Returns the containers along with the runs.
+    """
+    containers = list(_containers(areas))
+    size = max(1, sum(len(x.actions) for x in containers) // n)
+
+    runs = []
+    run = []
+    total = 0
+    for i, node in enumerate(containers):
+        start = 0
+        while start < len(node.actions):
+            stop = min(len(node.actions), start + size - total)
+            run.append((i, start, stop))
+            total += stop - start
+            start = stop
+
+            if total >= size:
+                runs.append(run)
+                run = []
+                total = 0
+
+    if run:
+        runs.append(run)
+    return containers, runs
@@ -0,0 +1,72 @@
+import os
+import re
+import sys
+
+from . import formatter as fmt
+
+_ANSI = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+
+class Screen:
+    """Keeps the rows currently on the terminal and redraws only those that
+    changed, using ANSI cursor movement. The whole screen is drawn again if
+    it does not fit the terminal, as it would scroll, and after clear().
+    """
+    CLEAR = '\x1b[H\x1b[2J'
+
+    def __init__(self):
+        self.lines = None  # rows on the screen, None if not known
+
+    def is_supported(self):
+        """ANSI codes need a terminal; on Windows they are translated by
+        colorama.
+        """
+        return sys.stdout.isatty() and (os.name != 'nt' or fmt.io_color)
+
+    def clear(self):
+        """Draw the whole screen again with the next update.
+        """
+        self.lines = None
+
+    def update(self, text, output=''):
+        """Show rendered items followed by the output of a command.
+        """
+        stream = sys.stdout
+
+        if not self.is_supported():
+            if stream.isatty():
+                os.system('cls' if os.name == 'nt' else 'clear')
+            stream.write(text + output)
+            stream.flush()
+            return
+
+        lines = _split(text)
+        size = fmt.terminal_size()
+        # leave room for the prompt and the line it moves to
+        fits = len(lines) + len(_split(output)) + 2 <= size.lines and \
+            all(_width(x) < size.columns for x in lines + _split(output))
+
+        if self.lines is None or not fits:
+            buf = [self.CLEAR, text, output]
+        else:
+            buf = []
+            for i, line in enumerate(lines):
+                if i >= len(self.lines) or self.lines[i] != line:
+                    buf.append('\x1b[{:d};1H{}\x1b[K'.format(i + 1, line))
+            buf.append('\x1b[{:d};1H\x1b[J'.format(len(lines) + 1))
+            buf.append(output)
+
+        stream.write(''.join(buf))
+        stream.flush()
+        self.lines = lines if fits else None
+
+
+def _split(text):
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+
+def _width(line):
+    return len(_ANSI.sub('', line))
@@ -0,0 +1,144 @@
+"""Serve commands to many clients from a single database kept in memory.
+
+    python -m gtd.server tasks.xml
+    python -m gtd.client 'done 3'
+    python -m gtd.client --show 'done 3'
+"""
+import argparse
+import contextlib
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from io import StringIO
+
+from . import formatter as fmt
+from . import io
+from .autosave import AutoSave
+from .interface import Interface
+
+END = b'\0'  # ends every reply
+SHOW = '+'  # asks for the list after a command
+
+
+def default_address(file_name):
+    return os.path.abspath(file_name) + '.sock'
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Reads commands, one per line, and answers each of them with whatever
+    the command printed. A command prefixed with SHOW is followed by the list
+    as well.
+    """
+    def handle(self):
+        for line in self.rfile:
+            cmd = line.decode('utf-8').strip()
+            show = cmd.startswith(SHOW)
+            if show:
+                cmd = cmd[len(SHOW):].lstrip()
+
+            if cmd == 'quit' or cmd == 'q':
+                break
+            if cmd:
+                reply = self.server.execute(cmd, show)
+                self.wfile.write(reply.encode('utf-8') + END)
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server sharing one Interface between its clients. Commands
+    are run one at a time, so clients see each other's changes in the order
+    they were made. Every change goes to the journal right away and the
+    file is written in the background by 'autosave', if given.
+    """
+    daemon_threads = True
+
+    def __init__(self, interface, address, autosave=None):
+        _remove_stale(address)
+        socketserver.UnixStreamServer.__init__(self, address, _Handler)
+        self.ui = interface
+        self.ui.autosave = autosave
+        self.autosave = autosave
+        self.lock = threading.Lock()
+
+    def execute(self, cmd, show=False):
+        """Run a command and return what it printed. The list is rendered
+        after commands which change what is shown, or if 'show' is set, as
+        rendering all of it would hold the other clients for long.
+        """
+        with self.lock:
+            output = StringIO()
+            with contextlib.redirect_stdout(output):
+                ok = self.ui._run_cmd(cmd)
+
+            if ok and (show or self.ui.is_display(cmd)):
+                output.write(fmt.format_items(self.ui._view(),
+                                              self.ui.options))
+
+            return output.getvalue()
+
+    def serve_forever(self, poll_interval=0.5):
+        if self.autosave is not None:
+            self.autosave.start()
+        try:
+            socketserver.UnixStreamServer.serve_forever(self, poll_interval)
+        finally:
+            if self.autosave is not None:
+                self.autosave.stop()
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def _remove_stale(address):
+    """Remove a socket left behind by a server which is not running anymore.
+    """
+    if not os.path.exists(address):
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+    except OSError:
+        os.remove(address)
+    else:
+        raise RuntimeError('A server is already listening at ' + address)
+    finally:
+        sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('file_name', nargs='?', default='tasks.xml')
+    parser.add_argument('--socket', help='path of the socket')
+    parser.add_argument('--interval', type=int, default=60,
+                        help='longest time between saves, in seconds')
+    parser.add_argument('--backend', choices=['xml', 'columns', 'sqlite'],
+                        default='xml', help='how the list is stored')
+    args = parser.parse_args(argv)
+
+    db = io.load(args.file_name, backend=args.backend)
+    server = Server(Interface(db), args.socket or
+                    default_address(args.file_name),
+                    AutoSave(db, args.file_name, max_delay=args.interval))
+
+    def _stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, _stop)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if db.journal is not None:
+            db.journal.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,568 @@
+import contextlib
+import os
+import sqlite3
+
+from . import db
+from . import items as it
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS areas (
+    id INTEGER PRIMARY KEY,
+    pos INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    archieved INTEGER NOT NULL DEFAULT 0,
+    deleted INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS projects (
+    id INTEGER PRIMARY KEY,
+    area INTEGER NOT NULL REFERENCES areas(id) ON DELETE CASCADE,
+    pos INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    description TEXT,
+    due INTEGER,
+    done INTEGER NOT NULL DEFAULT 0,
+    archieved INTEGER NOT NULL DEFAULT 0,
+    deleted INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS actions (
+    id INTEGER PRIMARY KEY,
+    area INTEGER NOT NULL REFERENCES areas(id) ON DELETE CASCADE,
+    project INTEGER REFERENCES projects(id) ON DELETE CASCADE,
+    pos INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    description TEXT,
+    due INTEGER,
+    done INTEGER NOT NULL DEFAULT 0,
+    archieved INTEGER NOT NULL DEFAULT 0,
+    deleted INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS tags (
+    action INTEGER NOT NULL REFERENCES actions(id) ON DELETE CASCADE,
+    name TEXT
+);
+CREATE INDEX IF NOT EXISTS projects_pos ON projects(area, pos);
+CREATE INDEX IF NOT EXISTS actions_pos ON actions(area, project, pos);
+CREATE INDEX IF NOT EXISTS actions_project ON actions(project);
+CREATE INDEX IF NOT EXISTS actions_done ON actions(done);
+CREATE INDEX IF NOT EXISTS actions_archieved ON actions(archieved);
+CREATE INDEX IF NOT EXISTS actions_due ON actions(due);
+CREATE INDEX IF NOT EXISTS tags_name ON tags(name, action);
+CREATE INDEX IF NOT EXISTS tags_action ON tags(action);
+"""
+
+# names are stored lowercased, so that they are matched the same way as
+# str.lower() does, rather than by the case folding of SQLite
+_NAMES = """
+CREATE VIRTUAL TABLE IF NOT EXISTS {0}_names USING fts5(
+    name, tokenize = 'trigram case_sensitive 1'
+);
+"""
+
+_TABLES = ['areas', 'projects', 'actions']
+
+
+class SQLDataBase(db.DataBase):
+    """DataBase kept in an SQLite file. Items still live in memory, but every
+    command is written through to the tables and filters of a query are
+    evaluated by SQLite using its indexes. Names are looked up in full-text
+    tables of their trigrams, if SQLite has them.
+
+    Items are mapped to their rows by item ids. Rows remember the position
+    of their item in the lists of its parent, so that items are read in the
+    same order. Deleted items keep their rows until the database is compacted
+    or the file is read again.
+    """
+
+    def __init__(self, file_name):
+        super(SQLDataBase, self).__init__()
+        self.file_name = file_name
+        self._in_batch = False
+        self._rows = {}  # item id -> (table, row id)
+        self._actions = {}  # row id of an action -> item id
+        self.conn = sqlite3.connect(file_name, check_same_thread=False)
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        self.conn.create_function('contains', 2, _contains)
+        self.conn.executescript(_SCHEMA)
+        self._fts = _create_names(self.conn)
+
+    def close(self):
+        self.conn.close()
+
+    def commit(self):
+        self.conn.commit()
+
+    def read(self):
+        """Build items from the tables. Positions are renumbered on the way, as
+        deleted rows leave gaps behind them.
+        """
+        self.areas = []
+        self._rows = {}
+        self._actions = {}
+        areas = {}
+        projects = {}
+        actions = {}
+        moves = []
+
+        with self.conn:
+            for table in reversed(_TABLES):
+                self.conn.execute('DELETE FROM ' + table + ' WHERE deleted')
+            if self._fts:
+                self._sync_names()
+
+        for id_, pos, name, arch in self.conn.execute(
+                'SELECT id, pos, name, archieved FROM areas ORDER BY pos'):
+            area = it.Area(name)
+            area.is_archieved = bool(arch)
+            _renumber(moves, 'areas', id_, pos, len(self.areas))
+            areas[id_] = area
+            self.areas.append(area)
+
+        for row in self.conn.execute(
+                'SELECT id, area, pos, name, description, due, done, '
+                'archieved FROM projects ORDER BY area, pos'):
+            id_, area, pos = row[:3]
+            project = _fill(it.Project(row[3]), row[4:])
+            _renumber(moves, 'projects', id_, pos,
+                      len(areas[area].projects))
+            projects[id_] = project
+            areas[area].projects.append(project)
+
+        for row in self.conn.execute(
+                'SELECT id, area, project, pos, name, description, due, '
+                'done, archieved FROM actions ORDER BY area, project, pos'):
+            id_, area, project, pos = row[:4]
+            action = _fill(it.Action(row[4]), row[5:])
+            parent = areas[area] if project is None else projects[project]
+            _renumber(moves, 'actions', id_, pos, len(parent.actions))
+            actions[id_] = action
+            parent.actions.append(action)
+
+        tags = {}
+        for action, name in self.conn.execute(
+                'SELECT action, name FROM tags ORDER BY rowid'):
+            tags.setdefault(action, []).append(name)
+        for action, names in tags.items():
+            actions[action].add_tags(names)
+
+        with self.conn:
+            for table, id_, pos in moves:
+                self.conn.execute('UPDATE ' + table + ' SET pos = ? '
+                                  'WHERE id = ?', (pos, id_))
+
+        self.reindex()
+
+        for table, items in [('areas', areas), ('projects', projects),
+                             ('actions', actions)]:
+            for row, item in items.items():
+                self._map(table, row, item.id)
+
+    def write(self, database):
+        """Store all items of another database into empty tables.
+        """
+        with self.conn:
+            for pos, area in enumerate(_live(database)):
+                self._insert_area(pos, area)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Apply a batch of commands in a single transaction.
+        """
+        if self._in_batch:
+            yield
+            return
+
+        self._in_batch = True
+        try:
+            yield
+        finally:
+            self._in_batch = False
+            self.commit()
+
+    @contextlib.contextmanager
+    def group(self):
+        with self.lock, self.events.held(), self.batch():
+            yield
+
+    def log(self, op, *args):
+        """Apply a command to the tables before it is applied to the items.
+        SQLite keeps its own journal, so nothing else is written.
+        """
+        if self._in_batch:
+            getattr(self, '_log_' + op)(*args)
+            return
+
+        with self.conn:
+            getattr(self, '_log_' + op)(*args)
+
+    def compact(self, keep=()):
+        """Remove deleted items along with their rows.
+        """
+        if self._in_batch:
+            return super(SQLDataBase, self).compact(keep)
+
+        with self.conn:
+            return super(SQLDataBase, self).compact(keep)
+
+    def _forget(self, node):
+        table, id_ = self._rows.pop(node.id)
+        if table == 'actions':
+            del self._actions[id_]
+
+        self.conn.execute('DELETE FROM ' + table + ' WHERE id = ?', (id_,))
+        if self._fts:
+            self.conn.execute('DELETE FROM ' + table + '_names '
+                              'WHERE rowid = ?', (id_,))
+        return super(SQLDataBase, self)._forget(node)
+
+    def _is_parallel(self):
+        # the connection cannot be used by forked processes
+        return False
+
+    def _filter(self, args, areas):
+        """Yield areas and projects to be shown along with their actions,
+        the same as DataBase._filter(). SQLite selects the actions to show
+        and the areas and projects holding actions which pass the filter
+        regardless of 'arch', so only containers are looked at here.
+        """
+        loose_args = dict(args)
+        loose_args.pop('arch', None)
+
+        named_areas = self._named_rows('areas', args['area']) \
+            if 'area' in args else None
+        named_projects = self._named_rows('projects', args['proj']) \
+            if 'proj' in args else None
+        area_actions = named_projects is None
+
+        groups = {}
+        sql, params = self._select('a.id', args)
+        for row, in self.conn.execute(sql + ' ORDER BY a.pos', params):
+            action = self.node(self._actions[row])
+            groups.setdefault(action.parent, []).append(action)
+
+        parents = None
+        if loose_args:
+            # with no filter of actions but names, any action passes
+            sql, params = self._select('DISTINCT a.area, a.project',
+                                       loose_args)
+            parents = set(('areas', area) if project is None
+                          else ('projects', project)
+                          for area, project in self.conn.execute(sql, params))
+
+        def _has_elem(node):
+            return parents is None or self._row(node) in parents
+
+        for area in areas:
+            if named_areas is not None and \
+                    self._row(area)[1] not in named_areas:
+                continue
+
+            if area_actions:
+                actions, has_elem = groups.get(area, []), _has_elem(area)
+            else:
+                actions, has_elem = [], not loose_args
+
+            projects = []
+            project_actions = {}
+            for project in area.projects:
+                if named_projects is not None and \
+                        self._row(project)[1] not in named_projects:
+                    continue
+                if _has_elem(project):
+                    projects.append(project)
+                    project_actions[project] = groups.get(project, [])
+
+            if has_elem or projects:
+                yield area, actions, projects, project_actions
+
+    def _select(self, columns, fltr):
+        """Query selecting columns of the actions 'a' passing the filter,
+        and its parameters.
+        """
+        clauses = []
+        params = []
+
+        for k, v in fltr.items():
+            if k == 'act':
+                sql, names = self._names('actions', v)
+                clauses.append('a.id IN (' + sql + ')')
+                params.extend(names)
+            elif k == 'tag':
+                clauses.append('a.id IN (SELECT action FROM tags WHERE name '
+                               'IN (' + ', '.join(['?'] * len(v)) + '))')
+                params.extend(v)
+            elif k == 'due':
+                clauses.append('a.due IS NOT NULL AND (' + ' OR '.join(
+                    'a.due ' + due.op + ' ?' for due in v) + ')')
+                params.extend(due.ordinal for due in v)
+                break  # filters after due are never checked
+            elif k == 'done':
+                clauses.append(_any('a.done = ?', len(v)))
+                params.extend(int(x) for x in v)
+            elif k == 'arch':
+                clauses.append(_any('a.archieved = ?', len(v)))
+                params.extend(int(x) for x in v)
+
+        for k, table, column in [('area', 'areas', 'a.area'),
+                                 ('proj', 'projects', 'a.project')]:
+            if k in fltr:
+                sql, names = self._names(table, fltr[k])
+                clauses.append(column + ' IN (' + sql + ')')
+                params.extend(names)
+
+        sql = 'SELECT ' + columns + ' FROM actions a'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join('(' + c + ')' for c in clauses)
+        return sql, params
+
+    def _names(self, table, texts):
+        """Query selecting ids of the rows of a table whose name contains
+        any of the given strings, ignoring the case, and its parameters.
+        Strings too short to have a trigram are looked for in all the names.
+        """
+        if not self._fts:
+            return ('SELECT id FROM ' + table + ' WHERE ' +
+                    _any('contains(name, ?)', len(texts)), list(texts))
+
+        selects = []
+        params = []
+        for text in texts:
+            text = text.lower()
+            if len(text) < 3:
+                selects.append('SELECT rowid FROM ' + table + '_names '
+                               'WHERE instr(name, ?)')
+                params.append(text)
+            else:
+                selects.append('SELECT rowid FROM ' + table + '_names '
+                               'WHERE ' + table + '_names MATCH ?')
+                params.append('"' + text.replace('"', '""') + '"')
+
+        return ' UNION '.join(selects), params
+
+    def _named_rows(self, table, texts):
+        sql, params = self._names(table, texts)
+        return set(row for row, in self.conn.execute(sql, params))
+
+    def _insert_name(self, table, row, name):
+        if self._fts:
+            self.conn.execute('INSERT INTO ' + table + '_names (rowid, name) '
+                              'VALUES (?, ?)', (row, name.lower()))
+
+    def _sync_names(self):
+        """Bring the name tables in line with the rows, e.g. of a file
+        written without them.
+        """
+        for table in _TABLES:
+            self.conn.execute('DELETE FROM ' + table + '_names WHERE rowid '
+                              'NOT IN (SELECT id FROM ' + table + ')')
+            missing = self.conn.execute(
+                'SELECT id, name FROM ' + table + ' WHERE id NOT IN '
+                '(SELECT rowid FROM ' + table + '_names)').fetchall()
+            for row, name in missing:
+                self._insert_name(table, row, name)
+
+    def _map(self, table, row, item_id):
+        self._rows[item_id] = (table, row)
+        if table == 'actions':
+            self._actions[row] = item_id
+
+    def _row(self, node):
+        """Return table and id of the row storing an item.
+        """
+        return self._rows[node.id]
+
+    def _parent_ids(self, node):
+        """Return ids of the area and project rows of a container.
+        """
+        if isinstance(node, it.Area):
+            return self._row(node)[1], None
+        return self._row(node.parent)[1], self._row(node)[1]
+
+    def _end(self, table, area, project=None):
+        """Position following the last row of a list. Moved and removed
+        items leave gaps, so it is not the length of the list.
+        """
+        sql = 'SELECT COALESCE(MAX(pos) + 1, 0) FROM ' + table + \
+            ' WHERE area = ?'
+        params = (area,)
+
+        if table == 'actions':
+            sql += ' AND project IS ?'
+            params += (project,)
+
+        return self.conn.execute(sql, params).fetchone()[0]
+
+    def _insert_area(self, pos, area):
+        cur = self.conn.execute(
+            'INSERT INTO areas (pos, name, archieved) VALUES (?, ?, ?)',
+            (pos, area.name, int(area.is_archieved)))
+        self._insert_name('areas', cur.lastrowid, area.name)
+
+        for pos, project in enumerate(_live(area.projects)):
+            self._insert_project(cur.lastrowid, pos, project)
+        for pos, action in enumerate(_live(area.actions)):
+            self._insert_action(cur.lastrowid, None, pos, action)
+
+        return cur.lastrowid
+
+    def _insert_project(self, area, pos, project):
+        cur = self.conn.execute(
+            'INSERT INTO projects (area, pos, name, description, due, done, '
+            'archieved) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (area, pos) + _columns(project))
+        self._insert_name('projects', cur.lastrowid, project.name)
+
+        for i, action in enumerate(_live(project.actions)):
+            self._insert_action(area, cur.lastrowid, i, action)
+
+        return cur.lastrowid
+
+    def _insert_action(self, area, project, pos, action):
+        cur = self.conn.execute(
+            'INSERT INTO actions (area, project, pos, name, description, '
+            'due, done, archieved) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (area, project, pos) + _columns(action))
+        self._insert_name('actions', cur.lastrowid, action.name)
+        self.conn.executemany('INSERT INTO tags (action, name) VALUES (?, ?)',
+                              [(cur.lastrowid, tag) for tag in action.tags])
+
+        return cur.lastrowid
+
+    def _log_add(self, parent, kind, name, item_id):
+        area, project = self._parent_ids(parent)
+
+        if kind == 'project':
+            row = self._insert_project(area, self._end('projects', area),
+                                       it.Project(name))
+            self._map('projects', row, item_id)
+        else:
+            row = self._insert_action(area, project,
+                                      self._end('actions', area, project),
+                                      it.Action(name))
+            self._map('actions', row, item_id)
+
+    def _log_arch(self, node):
+        self._cascade(node, 'archieved', 1)
+
+    def _log_clean(self, node, tags, due):
+        table, id_ = self._row(node)
+
+        if tags and table == 'actions':
+            self.conn.execute('DELETE FROM tags WHERE action = ?', (id_,))
+        if due and table != 'areas':
+            self.conn.execute('UPDATE ' + table + ' SET due = NULL '
+                              'WHERE id = ?', (id_,))
+
+    def _log_del(self, node):
+        table, id_ = self._row(node)
+        self.conn.execute('UPDATE ' + table + ' SET deleted = 1, '
+                          'archieved = 1 WHERE id = ?', (id_,))
+
+    def _log_desc(self, node, text):
+        table, id_ = self._row(node)
+        if table != 'areas':
+            self.conn.execute('UPDATE ' + table + ' SET description = ? '
+                              'WHERE id = ?', (text, id_))
+
+    def _log_done(self, node, undo):
+        self._cascade(node, 'done', int(not undo))
+
+    def _log_due(self, node, date):
+        table, id_ = self._row(node)
+        if table != 'areas':
+            self.conn.execute('UPDATE ' + table + ' SET due = ? WHERE id = ?',
+                              (it.parse_due(date), id_))
+
+    def _log_edit(self, node, name):
+        table, id_ = self._row(node)
+        self.conn.execute('UPDATE ' + table + ' SET name = ? WHERE id = ?',
+                          (name, id_))
+        if self._fts:
+            self.conn.execute('UPDATE ' + table + '_names SET name = ? '
+                              'WHERE rowid = ?', (name.lower(), id_))
+
+    def _log_move(self, node, dest):
+        area, project = self._parent_ids(dest)
+        pos = self._end('actions', area, project)
+        self.conn.execute('UPDATE actions SET area = ?, project = ?, pos = ? '
+                          'WHERE id = ?', (area, project, pos,
+                                           self._row(node)[1]))
+
+    def _log_tag(self, node, tags):
+        table, id_ = self._row(node)
+        if table == 'actions':
+            self.conn.executemany('INSERT INTO tags (action, name) '
+                                  'VALUES (?, ?)', [(id_, t) for t in tags])
+
+    def _cascade(self, node, column, value):
+        """Set a flag the way Action.mark_done and mark_archieved do, i.e. on
+        an item and everything it contains.
+        """
+        table, id_ = self._row(node)
+        update = 'UPDATE %s SET ' + column + ' = ? WHERE %s = ?'
+
+        if table == 'areas':
+            if column == 'archieved':
+                self.conn.execute(update % ('areas', 'id'), (value, id_))
+            self.conn.execute(update % ('projects', 'area'), (value, id_))
+            self.conn.execute(update % ('actions', 'area'), (value, id_))
+        elif table == 'projects':
+            self.conn.execute(update % ('projects', 'id'), (value, id_))
+            self.conn.execute(update % ('actions', 'project'), (value, id_))
+        else:
+            self.conn.execute(update % ('actions', 'id'), (value, id_))
+
+
+def load(file_name, source=None):
+    """Open a database stored in an SQLite file. A new file is filled with
+    the items of the 'source' database, or a single Inbox area.
+    """
+    is_new = not os.path.isfile(file_name)
+    database = SQLDataBase(file_name)
+
+    if is_new:
+        if source is None:
+            source = [it.Area('Inbox')]
+        database.write(source)
+
+    database.read()
+    return database
+
+
+def _create_names(conn):
+    """Create the tables of name trigrams. Returns False if SQLite has been
+    built without them.
+    """
+    try:
+        for table in _TABLES:
+            conn.execute(_NAMES.format(table))
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+def _contains(name, text):
+    return text.lower() in name.lower()
+
+
+def _any(clause, n):
+    return ' OR '.join([clause] * n)
+
+
+def _columns(item):
+    return (item.name, item.description, item.due,
+            int(item.is_done), int(item.is_archieved))
+
+
+def _fill(item, row):
+    item.description, item.due = row[0] or '', row[1]
+    item.is_done, item.is_archieved = bool(row[2]), bool(row[3])
+    return item
+
+
+def _live(items):
+    return [x for x in items if not x.is_deleted]
+
+
+def _renumber(moves, table, id_, pos, new_pos):
+    if pos != new_pos:
+        moves.append((table, id_, new_pos))
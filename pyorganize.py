@@ -14,11 +14,46 @@
     You should have received a copy of the GNU General Public License
     along with this program. If not, see http://www.gnu.org/licenses/.
 """
+import argparse
+import sys
+
 import gtd
 
 
-if __name__ == '__main__':
-    db = gtd.load('tasks.xml')
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Command-line todo app.')
+    parser.add_argument('file_name', nargs='?', default='tasks.xml')
+    parser.add_argument('-b', '--batch', metavar='SCRIPT',
+                        help="run commands from a file, or '-' for stdin, "
+                             "and save once at the end")
+    parser.add_argument('--show', action='store_true',
+                        help='print the list after a batch')
+    parser.add_argument('--backend', choices=['xml', 'columns', 'sqlite'],
+                        default='xml', help='how the list is stored')
+    args = parser.parse_args(argv)
+
+    db = gtd.load(args.file_name, backend=args.backend)
     ui = gtd.Interface(db)
-    ui.start()
-    gtd.save(db)
+
+    if args.batch:
+        if args.batch == '-':
+            failed = ui.batch(sys.stdin, show=args.show)
+        else:
+            with open(args.batch, 'r', encoding='utf-8') as f:
+                failed = ui.batch(f, show=args.show)
+    else:
+        autosave = gtd.AutoSave(db, args.file_name).start()
+        ui.autosave = autosave
+        try:
+            ui.start()
+        finally:
+            autosave.stop()
+        failed = 0
+
+    if db.journal is not None:
+        db.journal.close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""Changes must survive the process being dropped without a save: loading
+the file again replays the journal on top of it and gives the same items.
+"""
+import pytest
+
+from gtd import io
+
+# written before items had ids
+LEGACY = """<?xml version="1.0" encoding="UTF-8"?>
+<data>
+	<area name="Inbox">
+		<action archieved="False" done="False" name="Sample task">
+			<description>Description</description>
+			<tag>py</tag>
+		</action>
+		<action archieved="False" done="False" name="Call Bob">
+			<due>01-02-2021</due>
+		</action>
+	</area>
+	<area name="Next">
+		<project archieved="False" done="False" name="Sample">
+			<action archieved="False" done="False" name="Task in project"/>
+			<action archieved="False" done="True" name="Done task"/>
+		</project>
+		<action archieved="False" done="False" name="Task 1"/>
+	</area>
+	<area name="Someday"/>
+</data>
+"""
+
+
+def _load(tmp_path):
+    file_name = tmp_path / 'tasks.xml'
+    if not file_name.exists():
+        file_name.write_text(LEGACY, encoding='utf-8')
+    return io.load(str(file_name))
+
+
+def _crash(database):
+    """Drop the database without saving it, as a killed process would."""
+    database.journal.close()
+
+
+def _items(database):
+    """Live items in their order, along with their ids and parents."""
+    items = []
+
+    def _add(node):
+        items.append((type(node).__name__, node.id,
+                      node.parent.id if node.parent is not None else None,
+                      node.name, node.description, node.is_done,
+                      node.is_archieved, node.due, node.tags))
+
+    for area in database:
+        if area.is_deleted:
+            continue
+        _add(area)
+        for action in area.actions:
+            if not action.is_deleted:
+                _add(action)
+        for project in area.projects:
+            if project.is_deleted:
+                continue
+            _add(project)
+            for action in project.actions:
+                if not action.is_deleted:
+                    _add(action)
+
+    return items
+
+
+def _find(database, name):
+    for node in database.query():
+        if node.name == name:
+            return node
+    raise KeyError(name)
+
+
+def _change(database):
+    _, next_, someday = database.areas
+    project = next_.projects[0]
+
+    database.apply('add', someday, 'action', 'New action')
+    new_project = database.apply('add', someday, 'project', 'New project')
+    database.apply('add', new_project, 'action', 'In new project')
+    database.apply('edit', _find(database, 'Task 1'), 'Renamed task')
+    database.apply('tag', _find(database, 'Call Bob'), ['phone', 'home'])
+    database.apply('due', _find(database, 'Sample task'), '15-03-2021')
+    database.apply('desc', _find(database, 'Renamed task'), 'Some text')
+    database.apply('done', _find(database, 'Task in project'), False)
+    database.apply('move', _find(database, 'Call Bob'), project)
+    database.apply('del', _find(database, 'Done task'))
+    database.apply('arch', _find(database, 'Sample task'))
+
+
+def test_legacy_items_get_ids(tmp_path):
+    database = _load(tmp_path)
+    ids = [x[1] for x in _items(database)]
+
+    assert None not in ids
+    assert len(set(ids)) == len(ids)
+
+
+def test_ids_stay_when_items_without_ids_are_added(tmp_path):
+    database = _load(tmp_path)
+    database.apply('desc', _find(database, 'Task 1'), 'Saved text')
+    io.save(database, str(tmp_path / 'tasks.xml'))
+    _crash(database)
+    expected = _items(database)
+
+    file_name = tmp_path / 'tasks.xml'
+    text = file_name.read_text(encoding='utf-8')
+    file_name.write_text(text.replace(
+        '<area', '<area name="Added"/>\n\t<area', 1), encoding='utf-8')
+
+    items = _items(_load(tmp_path))
+    assert items[0][3] == 'Added'
+    assert items[0][1] > max(x[1] for x in expected)
+    assert items[1:] == expected
+
+
+def test_replay_after_crash(tmp_path):
+    database = _load(tmp_path)
+    _change(database)
+    expected = _items(database)
+    _crash(database)
+
+    assert _items(_load(tmp_path)) == expected
+
+
+def test_replay_after_save(tmp_path):
+    database = _load(tmp_path)
+    database.apply('desc', _find(database, 'Task 1'), 'Saved text')
+    io.save(database, str(tmp_path / 'tasks.xml'))
+    _change(database)
+    database.apply('edit', _find(database, 'Renamed task'), 'After save')
+    expected = _items(database)
+    _crash(database)
+
+    reloaded = _load(tmp_path)
+    assert _items(reloaded) == expected
+    assert len(reloaded.journal) == 12
+
+
+def test_replay_after_compact(tmp_path):
+    database = _load(tmp_path)
+    database.apply('del', _find(database, 'Sample'))
+    database.apply('del', _find(database, 'Sample task'))
+    assert database.compact() == 4
+
+    someday = database.areas[2]
+    new_project = database.apply('add', someday, 'project', 'New project')
+    database.apply('move', _find(database, 'Task 1'), new_project)
+    database.apply('add', new_project, 'action', 'Another one')
+    database.apply('done', new_project, False)
+    expected = _items(database)
+    _crash(database)
+
+    assert _items(_load(tmp_path)) == expected
+
+
+def test_torn_write_is_cut_off(tmp_path):
+    database = _load(tmp_path)
+    database.apply('edit', _find(database, 'Task 1'), 'First')
+    _crash(database)
+
+    with open(database.journal.file_name, 'a', encoding='utf-8') as fOut:
+        fOut.write('[2, "edit", 2, "to')
+
+    database = _load(tmp_path)
+    database.apply('edit', _find(database, 'Call Bob'), 'Second')
+    expected = _items(database)
+    _crash(database)
+
+    reloaded = _load(tmp_path)
+    assert _items(reloaded) == expected
+    assert _find(reloaded, 'First') and _find(reloaded, 'Second')
+
+
+def test_broken_record_stops_replay(tmp_path):
+    database = _load(tmp_path)
+    database.apply('edit', _find(database, 'Task 1'), 'First')
+    database.apply('edit', _find(database, 'Call Bob'), 'Second')
+    _crash(database)
+
+    file_name = database.journal.file_name
+    with open(file_name, 'rb') as fIn:
+        first, second = fIn.readlines()
+    with open(file_name, 'wb') as fOut:
+        fOut.write(first[:-5] + b'\n' + second)
+
+    with pytest.raises(ValueError):
+        _load(tmp_path)
+    with open(file_name, 'rb') as fIn:
+        assert fIn.read() == first[:-5] + b'\n' + second